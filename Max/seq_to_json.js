@@ -38,6 +38,27 @@ function addNotes(pitch, velocity, startTime, endTime) {
   clipApi.call("add_new_notes", notesJson);
 }
 
+// typed payload (--osc_payload typed): pitch, velocity, startTime, endTime
+// repeated for every note, added with a single add_new_notes call
+function addNoteList() {
+  if (clipApi == null) throw "No clip";
+
+  clipApi.call("fire");
+
+  var noteArray = [];
+  for (var i = 0; i + 3 < arguments.length; i += 4) {
+    noteArray.push({
+      pitch: arguments[i],
+      start_time: arguments[i + 2],
+      duration: arguments[i + 3] - arguments[i + 2],
+      velocity: arguments[i + 1],
+    });
+  }
+
+  post("added " + noteArray.length + " new notes");
+  clipApi.call("add_new_notes", JSON.stringify({ notes: noteArray }));
+}
+
 function clearNotes(time_span) {
   // メロディ生成のの場合は16小節なので16を64に変更
   clipApi.call("remove_notes_extended", 0, 127, 0, time_span);
@@ -138,6 +138,7 @@ class SmallMusicVAE(object):
         """
         self._encoder = encoder
         self._decoder = decoder
+        self._latent_decoder_layers = None
 
     def build(self, hparams, output_depth, encoder_train=False, decoder_train=False):
         """
@@ -156,6 +157,8 @@ class SmallMusicVAE(object):
             hparams.values())
         self.global_step = tf.train.get_or_create_global_step()
         self._hparams = hparams
+        # Layers belong to the graph being built, so drop those of a previous one.
+        self._latent_decoder_layers = None
         self._encoder.build(hparams, encoder_train)
         self._decoder.build(hparams, output_depth, decoder_train)
 
@@ -255,22 +258,27 @@ class SmallMusicVAE(object):
         latent_decoder_layers = hparams.latent_decoder_layers
         z_size = hparams.z_size
 
-        x = latent_z
-        for i, layer_size in enumerate(latent_decoder_layers):
-            x = tf.layers.Dense(
-                layer_size,
-                name='latent_decoder/layer{}'.format(i),
-                activation='relu'
-            )(x)
+        # Layers are created once per graph so that every call shares the same weights.
+        if self._latent_decoder_layers is None:
+            self._latent_decoder_layers = [
+                tf.layers.Dense(
+                    layer_size,
+                    name='latent_decoder/layer{}'.format(i),
+                    activation='relu'
+                ) for i, layer_size in enumerate(latent_decoder_layers)
+            ]
+            # Recreate z distribution
+            self._latent_decoder_layers.append(tf.layers.Dense(
+                z_size,
+                name='latent_decoder/mu',
+                kernel_initializer=tf.random_normal_initializer(stddev=0.001)
+            ))
 
-        # Recreate z distribution
-        mu = tf.layers.Dense(
-            z_size,
-            name='latent_decoder/mu',
-            kernel_initializer=tf.random_normal_initializer(stddev=0.001)
-        )(x)
+        x = latent_z
+        for layer in self._latent_decoder_layers:
+            x = layer(x)
 
-        return mu
+        return x
 
     def _latent_reconstruction_loss(self, z, latent_z):
         """
@@ -428,6 +436,10 @@ class SmallMusicVAE(object):
 
         z = self._decode_latent(latent_z)
 
+        return self.sample_from_z(n, max_length, z, c_input, **kwargs)
+
+    def sample_from_z(self, n, max_length=None, z=None, c_input=None, **kwargs):
+        """Sample from the MusicVAE decoder with a full `z`, skipping the latent decoder."""
         return self.decoder.sample(n, max_length, z, c_input, **kwargs)
 
 
@@ -753,4 +765,8 @@ class LCMusicVAE(object):
 
         z = self._decode_latent(latent_z).sample()
 
+        return self.sample_from_z(n, max_length, z, c_input, **kwargs)
+
+    def sample_from_z(self, n, max_length=None, z=None, c_input=None, **kwargs):
+        """Sample from the MusicVAE decoder with a full `z`, skipping the latent decoder."""
         return self.decoder.sample(n, max_length, z, c_input, **kwargs)
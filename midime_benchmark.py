@@ -0,0 +1,220 @@
+"""Benchmarks TrainedModel decoding with random weights, no checkpoints needed."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import multiprocessing
+import os
+import resource
+import time
+
+from magenta.models.music_vae import configs as vae_configs
+import numpy as np
+import tensorflow.compat.v1 as tf   # pylint: disable=import-error
+
+import midime_configs as configs
+from midime_trained_model import TrainedModel
+
+
+flags = tf.app.flags
+logging = tf.logging
+FLAGS = flags.FLAGS
+
+# MusicVAE config every MidiMe config is trained on top of.
+VAE_CONFIG_NAMES = {
+    'cat-mel_2bar_big_3dim': 'cat-mel_2bar_big',
+    'cat-drums_2bar_small_3dim': 'cat-drums_2bar_small',
+    'hierdec-trio_16bar_3dim': 'hierdec-trio_16bar',
+    'bass_16bar_3dim': 'hierdec-trio_16bar',
+}
+BASS_CONFIG_NAMES = ['bass_16bar_3dim']
+
+flags.DEFINE_list(
+    'configs', ['cat-mel_2bar_big_3dim', 'hierdec-trio_16bar_3dim', 'bass_16bar_3dim'],
+    'Comma-separated MidiMe configs to benchmark.'
+)
+flags.DEFINE_list(
+    'batch_sizes', ['1', '2', '4', '8'],
+    'Comma-separated batch sizes. One graph is built per config with a decode '
+    'op for each of them (see `batch_buckets`).'
+)
+flags.DEFINE_list(
+    'max_seq_lens', [],
+    'Comma-separated decode lengths. Defaults to the `max_seq_len` of each config.'
+)
+flags.DEFINE_list(
+    'ops', ['decode', 'sample'],
+    'What to time: `decode` (`decode_to_tensors` of random z\') and/or `sample` '
+    '(`sample`, including the conversion to NoteSequences).'
+)
+flags.DEFINE_integer(
+    'repeats', 5,
+    'Timed runs per measurement.'
+)
+flags.DEFINE_integer(
+    'warmup', 1,
+    'Untimed runs before each measurement.'
+)
+flags.DEFINE_integer(
+    'intra_op_threads', 0,
+    'TF intra-op threads of the session (0: auto).'
+)
+flags.DEFINE_integer(
+    'inter_op_threads', 0,
+    'TF inter-op threads of the session (0: auto).'
+)
+flags.DEFINE_bool(
+    'isolate', True,
+    'Whether to benchmark every config in a fresh process, so that its peak RSS '
+    'is not inflated by the configs before it.'
+)
+flags.DEFINE_string(
+    'output_path', None,
+    'Path of the JSON report. Printed to stdout if not given.'
+)
+flags.DEFINE_string(
+    'log', 'INFO',
+    'The threshold for what messages will be logged: '
+    'DEBUG, INFO, WARN, ERROR, or FATAL.'
+)
+
+
+def _peak_rss_mb():
+    """Peak resident set size of this process so far (`ru_maxrss` is in KiB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _time(func, repeats, warmup):
+    """Seconds of every timed call of `func`."""
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def benchmark_config(config_name, batch_sizes, max_seq_lens=None, ops=('decode', 'sample'),
+                     repeats=5, warmup=1, intra_op_threads=0, inter_op_threads=0):
+    """
+    Builds one config with random weights and times it for every batch size and length.
+    :param config_name: Name of a MidiMe config in `VAE_CONFIG_NAMES`.
+    :param batch_sizes: Batch sizes to build decode ops for and time.
+    :param max_seq_lens: Decode lengths, the config's `max_seq_len` if empty.
+    :return:
+        A JSON-serializable dictionary with the build time, peak RSS and one
+        result per op, batch size and length. Failing measurements hold an `error`.
+    """
+    config = configs.CONFIG_MAP[config_name]
+    vae_config = vae_configs.CONFIG_MAP[VAE_CONFIG_NAMES[config_name]]
+    batch_sizes = sorted(set(int(b) for b in batch_sizes))
+    rss_before = _peak_rss_mb()
+
+    start = time.perf_counter()
+    model = TrainedModel(
+        vae_config=vae_config, model_config=config, batch_size=batch_sizes[-1],
+        is_bass_model=config_name in BASS_CONFIG_NAMES,
+        intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads,
+        batch_buckets=batch_sizes[:-1])
+    build_sec = time.perf_counter() - start
+    max_seq_lens = [int(n) for n in max_seq_lens or []] or [config.hparams.max_seq_len]
+
+    results = []
+    for length in max_seq_lens:
+        for batch_size in batch_sizes:
+            z = np.random.randn(batch_size, model.encoded_z_size).astype(np.float32)
+            funcs = {
+                'decode': lambda: model.decode_to_tensors(z, length=length),
+                'sample': lambda: model.sample(n=batch_size, length=length),
+            }
+            for op in ops:
+                result = {'op': op, 'batch_size': batch_size, 'max_seq_len': length}
+                try:
+                    times = np.asarray(_time(funcs[op], repeats, warmup))
+                except Exception as e:  # pylint: disable=broad-except
+                    logging.warning('%s %s failed: %s', config_name, result, e)
+                    result['error'] = str(e)
+                else:
+                    result.update({
+                        'median_ms': float(np.median(times)) * 1000,
+                        'min_ms': float(times.min()) * 1000,
+                        'per_sequence_ms': float(np.median(times)) * 1000 / batch_size,
+                    })
+                    logging.info('%s %s: %.1f ms per sequence', config_name, result,
+                                 result['per_sequence_ms'])
+                results.append(result)
+
+    return {
+        'config': config_name,
+        'vae_config': VAE_CONFIG_NAMES[config_name],
+        'build_sec': build_sec,
+        'peak_rss_mb': _peak_rss_mb(),
+        'peak_rss_before_build_mb': rss_before,
+        'results': results,
+    }
+
+
+def run(config_map):
+    """
+    Benchmarks every `--configs` entry and writes the JSON report.
+    :param config_map: MidiMe dictionary mapping configuration name to Config object.
+    :raises:
+        ValueError: if a config is unknown.
+    """
+    for name in FLAGS.configs:
+        if name not in config_map or name not in VAE_CONFIG_NAMES:
+            raise ValueError('Invalid MidiMe config name: %s' % name)
+    for op in FLAGS.ops:
+        if op not in ('decode', 'sample'):
+            raise ValueError('Invalid op: %s' % op)
+
+    kwargs = dict(batch_sizes=FLAGS.batch_sizes, max_seq_lens=FLAGS.max_seq_lens,
+                  ops=FLAGS.ops, repeats=FLAGS.repeats, warmup=FLAGS.warmup,
+                  intra_op_threads=FLAGS.intra_op_threads,
+                  inter_op_threads=FLAGS.inter_op_threads)
+    reports = []
+    for name in FLAGS.configs:
+        logging.info('Benchmarking %s...', name)
+        if FLAGS.isolate:
+            with multiprocessing.get_context('spawn').Pool(1) as pool:
+                reports.append(pool.apply(benchmark_config, (name,), kwargs))
+        else:
+            reports.append(benchmark_config(name, **kwargs))
+
+    report = {
+        'session': {
+            'intra_op_threads': FLAGS.intra_op_threads,
+            'inter_op_threads': FLAGS.inter_op_threads,
+            'cpu_count': os.cpu_count(),
+            'isolate': FLAGS.isolate,
+        },
+        'tensorflow_version': tf.__version__,
+        'configs': reports,
+    }
+    output = json.dumps(report, indent=2)
+    if FLAGS.output_path:
+        tf.gfile.MakeDirs(os.path.dirname(os.path.abspath(FLAGS.output_path)))
+        with tf.gfile.Open(FLAGS.output_path, 'w') as f:
+            f.write(output)
+        logging.info('Wrote %s', FLAGS.output_path)
+    else:
+        print(output)
+
+
+def main(unused_argv):
+    """Call benchmark function."""
+    logging.set_verbosity(FLAGS.log)
+    run(configs.CONFIG_MAP)
+
+
+def console_entry_point():
+    """Run entry point."""
+    tf.app.run(main)
+
+
+if __name__ == '__main__':
+    console_entry_point()
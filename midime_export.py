@@ -0,0 +1,180 @@
+"""Exports parts of trained MidiMe models for serving without rebuilding the graph."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+from magenta.models.music_vae import configs as vae_configs
+import tensorflow.compat.v1 as tf   # pylint: disable=import-error
+
+import midime_configs as configs
+from midime_latent_decoder import NumpyLatentDecoder
+from midime_trained_model import TrainedModel
+
+
+flags = tf.app.flags
+logging = tf.logging
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    'mode', 'latent_decoder',
+    'What to export. `latent_decoder`: the z\' -> z MLP weights as `.npz` for '
+    '`NumpyLatentDecoder`. `frozen_graph`: the MusicVAE and MidiMe checkpoints '
+    'folded into one inference graph `.pb` for `FrozenTrainedModel`.'
+)
+flags.DEFINE_string(
+    'run_dir', None,
+    'Path to the directory where the latest checkpoint will be loaded from.'
+)
+flags.DEFINE_string(
+    'checkpoint_file', None,
+    'Path to the checkpoint file. run_dir will take priority over this flag.'
+)
+flags.DEFINE_string(
+    'vae_checkpoint_file', None,
+    'In `frozen_graph` mode, path to the MusicVAE checkpoint file.'
+)
+flags.DEFINE_string(
+    'config', None,
+    'In `frozen_graph` mode, the name of the MidiMe config to use.'
+)
+flags.DEFINE_string(
+    'vae_config', None,
+    'In `frozen_graph` mode, the name of pretrained MusicVAE model'
+)
+flags.DEFINE_bool(
+    'is_bass_model', False,
+    'In `frozen_graph` mode, whether the model generates only bass or not.'
+)
+flags.DEFINE_integer(
+    'batch_size', 4,
+    'In `frozen_graph` mode, the largest batch size to build the graph with.'
+)
+flags.DEFINE_list(
+    'batch_buckets', ['1'],
+    'In `frozen_graph` mode, comma-separated smaller batch sizes to export '
+    'decode ops for.'
+)
+flags.DEFINE_bool(
+    'decode_from_z', True,
+    'In `frozen_graph` mode, whether to also export the decode ops fed with full z.'
+)
+flags.DEFINE_bool(
+    'build_encoder', True,
+    'In `frozen_graph` mode, whether to also export the encoder.'
+)
+flags.DEFINE_string(
+    'output_path', None,
+    'Path of the exported file.'
+)
+flags.DEFINE_string(
+    'log', 'INFO',
+    'The threshold for what messages will be logged: '
+    'DEBUG, INFO, WARN, ERROR, or FATAL.'
+)
+
+
+def _checkpoint_path():
+    """Resolves `--run_dir`/`--checkpoint_file` to a checkpoint prefix."""
+    if (FLAGS.run_dir is None) == (FLAGS.checkpoint_file is None):
+        raise ValueError(
+            'Exactly one of `--run_dir` or `--checkpoint_file` must be specified.'
+        )
+    if FLAGS.run_dir:
+        checkpoint_path = tf.train.latest_checkpoint(
+            os.path.expanduser(os.path.join(FLAGS.run_dir, 'train')))
+    else:
+        checkpoint_path = os.path.expanduser(FLAGS.checkpoint_file)
+    if not checkpoint_path:
+        raise ValueError('No checkpoint found.')
+    return checkpoint_path
+
+
+def export_latent_decoder(checkpoint_path, output_path):
+    """
+    Pulls the `latent_decoder/*` weights out of a MidiMe checkpoint.
+    :param checkpoint_path: Path of the MidiMe checkpoint (prefix).
+    :param output_path: Path of the `.npz` file to write.
+    :return:
+        The exported NumpyLatentDecoder.
+    """
+    reader = tf.train.load_checkpoint(checkpoint_path)
+    names = [n for n in reader.get_variable_to_shape_map()
+             if n.startswith('latent_decoder/')]
+    decoder = NumpyLatentDecoder.from_variables({n: reader.get_tensor(n) for n in names})
+    decoder.save(output_path)
+    logging.info('Exported %d latent decoder layers (%d -> %d) to `%s`.',
+                 len(decoder.kernels), decoder.encoded_z_size, decoder.z_size, output_path)
+    return decoder
+
+
+def export_frozen_graph(checkpoint_path, output_path, config_map, vae_config_map):
+    """
+    Restores a MidiMe model and writes it as one frozen inference graph.
+    :param checkpoint_path: Path of the MidiMe checkpoint (prefix).
+    :param output_path: Path of the `.pb` file to write, the tensor names are
+        written next to it as `.json`.
+    :param config_map: MidiMe dictionary mapping configuration name to Config object.
+    :param vae_config_map: MusicVAE dictionary mapping configuration name to Config object.
+    :raises:
+        ValueError: if required flags are missing or invalid.
+    """
+    if FLAGS.vae_checkpoint_file is None:
+        raise ValueError('`--vae_checkpoint_file` is required.')
+    if FLAGS.config not in config_map:
+        raise ValueError('Invalid MidiMe config name: %s' % FLAGS.config)
+    if FLAGS.vae_config not in vae_config_map:
+        raise ValueError('Invalid MusicVAE config name: %s' % FLAGS.vae_config)
+
+    model = TrainedModel(
+        vae_config=vae_config_map[FLAGS.vae_config],
+        model_config=config_map[FLAGS.config],
+        batch_size=FLAGS.batch_size,
+        vae_checkpoint_dir_or_path=os.path.expanduser(FLAGS.vae_checkpoint_file),
+        model_checkpoint_dir_or_path=checkpoint_path,
+        model_var_pattern=['latent'], is_bass_model=FLAGS.is_bass_model,
+        batch_buckets=[int(b) for b in FLAGS.batch_buckets],
+        decode_from_z=FLAGS.decode_from_z,
+        build_encoder=FLAGS.build_encoder)
+    return model.export_frozen_graph(
+        output_path,
+        metadata={'config': FLAGS.config, 'vae_config': FLAGS.vae_config,
+                  'checkpoint': checkpoint_path})
+
+
+def run(config_map, vae_config_map):
+    """
+    Export according to `--mode`.
+    :param config_map: MidiMe dictionary mapping configuration name to Config object.
+    :param vae_config_map: MusicVAE dictionary mapping configuration name to Config object.
+    :raises:
+        ValueError: if required flags are missing or invalid.
+    """
+    if FLAGS.output_path is None:
+        raise ValueError('`--output_path` is required.')
+    tf.gfile.MakeDirs(os.path.dirname(os.path.abspath(FLAGS.output_path)))
+
+    if FLAGS.mode == 'latent_decoder':
+        export_latent_decoder(_checkpoint_path(), FLAGS.output_path)
+    elif FLAGS.mode == 'frozen_graph':
+        export_frozen_graph(
+            _checkpoint_path(), FLAGS.output_path, config_map, vae_config_map)
+    else:
+        raise ValueError('Invalid mode: %s' % FLAGS.mode)
+
+
+def main(unused_argv):
+    """Call export function."""
+    logging.set_verbosity(FLAGS.log)
+    run(configs.CONFIG_MAP, vae_configs.CONFIG_MAP)
+
+
+def console_entry_point():
+    """Run entry point."""
+    tf.app.run(main)
+
+
+if __name__ == '__main__':
+    console_entry_point()
@@ -74,6 +74,11 @@ flags.DEFINE_integer(
     'max_batch_size', 8,
     'The maximum batch size to use. Decrease if you are seeing an OOM.'
 )
+flags.DEFINE_list(
+    'batch_buckets', [],
+    'Comma-separated smaller batch sizes to build next to the maximum one, so '
+    'that the last partial batch is not padded up to `max_batch_size`.'
+)
 flags.DEFINE_float(
     'temperature', 0.5,
     'The randomness of the decoding process.'
@@ -128,7 +133,8 @@ def run(config_map, vae_config_map):
         vae_checkpoint_dir_or_path=vae_checkpoint_dir_or_path,
         model_checkpoint_dir_or_path=checkpoint_dir_or_path,
         model_var_pattern=['latent'], is_bass_model=FLAGS.is_bass_model,
-        session_target='')
+        session_target='',
+        batch_buckets=[int(b) for b in FLAGS.batch_buckets])
 
     logging.info('Sampling...')
     results = model.sample(
@@ -0,0 +1,83 @@
+"""NumPy implementation of the SmallMusicVAE latent decoder (z' -> z)."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import re
+
+import numpy as np
+
+_LAYER_RE = re.compile(r'^latent_decoder/layer(\d+)/kernel$')
+
+
+class NumpyLatentDecoder(object):
+    """
+    The `latent_decoder/*` MLP of `SmallMusicVAE._decode_latent` without a TF session.
+
+    Hidden layers use relu, the final `latent_decoder/mu` layer is linear, exactly
+    as in the graph. Points are mapped in one vectorized matmul per layer.
+
+    :param kernels: List of `[in, out]` weight matrices, the last one being `mu`.
+    :param biases: List of `[out]` bias vectors matching `kernels`.
+    """
+
+    def __init__(self, kernels, biases):
+        if len(kernels) != len(biases):
+            raise ValueError('Got %d kernels but %d biases.' % (len(kernels), len(biases)))
+        self.kernels = [np.asarray(k, dtype=np.float32) for k in kernels]
+        self.biases = [np.asarray(b, dtype=np.float32) for b in biases]
+
+    @property
+    def encoded_z_size(self):
+        return self.kernels[0].shape[0]
+
+    @property
+    def z_size(self):
+        return self.kernels[-1].shape[1]
+
+    @classmethod
+    def from_variables(cls, variables):
+        """
+        Builds the decoder from a mapping of variable name to value.
+        :param variables: Dictionary with `latent_decoder/layer{i}/kernel`, `.../bias`,
+            `latent_decoder/mu/kernel` and `latent_decoder/mu/bias` entries.
+        :raises:
+            ValueError: if the mapping has no `latent_decoder/mu` layer.
+        """
+        if 'latent_decoder/mu/kernel' not in variables:
+            raise ValueError('No `latent_decoder/mu` weights found.')
+        num_layers = len([name for name in variables if _LAYER_RE.match(name)])
+        names = ['latent_decoder/layer%d' % i for i in range(num_layers)]
+        names.append('latent_decoder/mu')
+        return cls([variables[n + '/kernel'] for n in names],
+                   [variables[n + '/bias'] for n in names])
+
+    def save(self, path):
+        arrays = {}
+        for i, (k, b) in enumerate(zip(self.kernels, self.biases)):
+            arrays['kernel_%d' % i] = k
+            arrays['bias_%d' % i] = b
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            num_layers = len([k for k in f.files if k.startswith('kernel_')])
+            return cls([f['kernel_%d' % i] for i in range(num_layers)],
+                       [f['bias_%d' % i] for i in range(num_layers)])
+
+    def __call__(self, latent_z):
+        """
+        Maps latent points to full MusicVAE z.
+        :param latent_z: Array sized `[..., encoded_z_size]`.
+        :return:
+            A float32 array sized `[..., z_size]`.
+        """
+        x = np.asarray(latent_z, dtype=np.float32)
+        last = len(self.kernels) - 1
+        for i, (kernel, bias) in enumerate(zip(self.kernels, self.biases)):
+            x = np.matmul(x, kernel) + bias
+            if i != last:
+                np.maximum(x, 0.0, out=x)
+        return x
@@ -0,0 +1,129 @@
+"""Precomputed decodes of a regular grid over the small MidiMe latent space."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+def output_depths_of(data_converter):
+    """Depths of the one-hot sections in a converter's output tensors."""
+    depths = getattr(data_converter, '_split_output_depths', None)
+    return list(depths) if depths else [data_converter.output_depth]
+
+
+class LatentGrid(object):
+    """
+    Decoded output tensors for every voxel of a cube in the `encoded_z_size` space.
+
+    Only the argmax index of every one-hot section is kept, so even a 16 bar trio
+    grid stays small. Lookups rebuild the one-hot tensor for the nearest voxel, or a
+    distance weighted vote over the surrounding voxels when blending.
+
+    :param axes: Array sized `[encoded_z_size, grid_size]` with the voxel centers of
+        each axis.
+    :param indices: Int array sized `grid_size ** encoded_z_size + [length, num_sections]`.
+    :param output_depths: Depth of every one-hot section of the output tensor.
+    :param metadata: Dictionary of strings/numbers describing how the grid was made
+        (configs, temperature, length).
+    """
+
+    def __init__(self, axes, indices, output_depths, metadata=None):
+        self.axes = np.asarray(axes, dtype=np.float32)
+        self.indices = np.asarray(indices)
+        self.output_depths = list(output_depths)
+        self.metadata = dict(metadata or {})
+        self._low = self.axes[:, 0]
+        self._step = self.axes[:, 1] - self.axes[:, 0]
+
+    @property
+    def grid_shape(self):
+        return self.indices.shape[:self.axes.shape[0]]
+
+    @property
+    def length(self):
+        return self.indices.shape[self.axes.shape[0]]
+
+    @staticmethod
+    def make_axes(grid_size, low=-6.0, high=6.0, dims=3):
+        """Voxel centers for a cube spanning `[low, high]` on every axis."""
+        axis = np.linspace(low, high, grid_size, dtype=np.float32)
+        return np.tile(axis, (dims, 1))
+
+    @staticmethod
+    def points(axes):
+        """All voxel centers as an array sized `[num_points, dims]` in C order."""
+        mesh = np.meshgrid(*axes, indexing='ij')
+        return np.stack([m.ravel() for m in mesh], axis=-1).astype(np.float32)
+
+    @classmethod
+    def from_tensors(cls, axes, tensors, output_depths, metadata=None):
+        """
+        Builds a grid from decoded tensors of every point in `points(axes)`.
+        :param tensors: Array sized `[num_points, length, sum(output_depths)]`.
+        """
+        tensors = np.asarray(tensors)
+        bounds = np.cumsum([0] + list(output_depths))
+        indices = np.stack(
+            [np.argmax(tensors[..., b:e], axis=-1)
+             for b, e in zip(bounds[:-1], bounds[1:])],
+            axis=-1).astype(np.int16)
+        shape = [axes.shape[1]] * axes.shape[0] + list(indices.shape[1:])
+        return cls(axes, indices.reshape(shape), output_depths, metadata)
+
+    def save(self, path):
+        np.savez_compressed(
+            path, axes=self.axes, indices=self.indices,
+            output_depths=np.asarray(self.output_depths),
+            metadata_keys=np.asarray(list(self.metadata.keys()), dtype=str),
+            metadata_values=np.asarray(
+                [str(v) for v in self.metadata.values()], dtype=str))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            metadata = dict(zip(f['metadata_keys'].tolist(),
+                                f['metadata_values'].tolist()))
+            return cls(f['axes'], f['indices'], f['output_depths'].tolist(), metadata)
+
+    def _to_one_hot(self, indices, weights=None):
+        """Votes `[k, length, num_sections]` indices into one one-hot tensor."""
+        if weights is None:
+            weights = np.ones(indices.shape[0], dtype=np.float32)
+        sections = []
+        for s, depth in enumerate(self.output_depths):
+            votes = np.zeros((indices.shape[1], depth), dtype=np.float32)
+            for k in range(indices.shape[0]):
+                votes[np.arange(indices.shape[1]), indices[k, :, s]] += weights[k]
+            one_hot = np.zeros_like(votes)
+            one_hot[np.arange(votes.shape[0]), np.argmax(votes, axis=-1)] = 1.0
+            sections.append(one_hot)
+        return np.concatenate(sections, axis=-1)
+
+    def lookup(self, latent_z, blend=False):
+        """
+        Returns the output tensor for a latent point.
+        :param latent_z: Array sized `[encoded_z_size]` (or `[1, encoded_z_size]`).
+        :param blend: Whether to vote over the surrounding voxels, weighted by
+            trilinear distance, instead of taking the nearest voxel.
+        :return:
+            A float32 array sized `[length, sum(output_depths)]`.
+        """
+        z = np.asarray(latent_z, dtype=np.float32).reshape(-1)
+        upper = np.asarray(self.grid_shape) - 1
+        position = np.clip((z - self._low) / self._step, 0, upper)
+        if not blend:
+            nearest = tuple(np.rint(position).astype(int))
+            return self._to_one_hot(self.indices[nearest][np.newaxis])
+
+        floor = np.minimum(np.floor(position).astype(int), np.maximum(upper - 1, 0))
+        frac = position - floor
+        corners = []
+        weights = []
+        for offset in np.ndindex(*([2] * z.shape[0])):
+            offset = np.asarray(offset)
+            corner = np.minimum(floor + offset, upper)
+            corners.append(self.indices[tuple(corner)])
+            weights.append(np.prod(np.where(offset, frac, 1.0 - frac)))
+        return self._to_one_hot(np.stack(corners), np.asarray(weights, np.float32))
@@ -0,0 +1,157 @@
+"""Precomputes decodes of a latent grid for answering `/z_*` requests by lookup."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import numpy as np
+from magenta.models.music_vae import configs as vae_configs
+import tensorflow.compat.v1 as tf   # pylint: disable=import-error
+
+import midime_configs as configs
+from midime_latent_grid import LatentGrid, output_depths_of
+from midime_trained_model import TrainedModel
+
+
+flags = tf.app.flags
+logging = tf.logging
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    'run_dir', None,
+    'Path to the directory where the latest checkpoint will be loaded from.'
+)
+flags.DEFINE_string(
+    'checkpoint_file', None,
+    'Path to the checkpoint file. run_dir will take priority over this flag.'
+)
+flags.DEFINE_string(
+    'vae_checkpoint_file', None,
+    'Path to the MusicVAE checkpoint file.'
+)
+flags.DEFINE_string(
+    'output_path', None,
+    'Path of the `.npz` file the grid will be saved to.'
+)
+flags.DEFINE_string(
+    'config', None,
+    'The name of the config to use.'
+)
+flags.DEFINE_string(
+    'vae_config', None,
+    'The name of pretrained MusicVAE model'
+)
+flags.DEFINE_bool(
+    'is_bass_model', False,
+    'Whether to generate only bass or not.'
+)
+flags.DEFINE_integer(
+    'grid_size', 9,
+    'Number of voxels along every latent axis.'
+)
+flags.DEFINE_float(
+    'grid_min', -6.0,
+    'Lower bound of every latent axis. The OSC server scales xyz by 6.'
+)
+flags.DEFINE_float(
+    'grid_max', 6.0,
+    'Upper bound of every latent axis.'
+)
+flags.DEFINE_integer(
+    'max_batch_size', 8,
+    'The maximum batch size to use. Decrease if you are seeing an OOM.'
+)
+flags.DEFINE_float(
+    'temperature', 1.0,
+    'The randomness of the decoding process. Keep the 1.0 the server decodes '
+    'live at, it warns when loading a grid made at another temperature.'
+)
+flags.DEFINE_string(
+    'log', 'INFO',
+    'The threshold for what messages will be logged: '
+    'DEBUG, INFO, WARN, ERROR, or FATAL.'
+)
+
+
+def run(config_map, vae_config_map):
+    """
+    Decode every voxel of the latent grid and save the result.
+    :param config_map: MidiMe dictionary mapping configuration name to Config object.
+    :param vae_config_map: MusicVAE dictionary mapping configuration name to Config object.
+    :raises:
+        ValueError: if required flags are missing or invalid.
+    """
+    if (FLAGS.run_dir is None) == (FLAGS.checkpoint_file is None):
+        raise ValueError(
+            'Exactly one of `--run_dir` or `--checkpoint_file` must be specified.'
+        )
+    if FLAGS.vae_checkpoint_file is None:
+        raise ValueError(
+            '`--vae_checkpoint_file` is required.'
+        )
+    if FLAGS.output_path is None:
+        raise ValueError('`--output_path` is required.')
+    if FLAGS.grid_size < 2:
+        raise ValueError('`--grid_size` must be at least 2.')
+    tf.gfile.MakeDirs(os.path.dirname(os.path.abspath(FLAGS.output_path)))
+
+    if FLAGS.config not in config_map:
+        raise ValueError('Invalid MidiMe config name: %s' % FLAGS.config)
+    config = config_map[FLAGS.config]
+    if FLAGS.vae_config not in vae_config_map:
+        raise ValueError('Invalid MusicVAE config name: %s' % FLAGS.vae_config)
+    vae_config = vae_config_map[FLAGS.vae_config]
+    config.data_converter.max_tensors_per_item = None
+
+    logging.info('Loading model...')
+    if FLAGS.run_dir:
+        checkpoint_dir_or_path = os.path.expanduser(
+            os.path.join(FLAGS.run_dir, 'train'))
+    else:
+        checkpoint_dir_or_path = os.path.expanduser(FLAGS.checkpoint_file)
+    vae_checkpoint_dir_or_path = os.path.expanduser(FLAGS.vae_checkpoint_file)
+    model = TrainedModel(
+        vae_config=vae_config, model_config=config,
+        batch_size=FLAGS.max_batch_size,
+        vae_checkpoint_dir_or_path=vae_checkpoint_dir_or_path,
+        model_checkpoint_dir_or_path=checkpoint_dir_or_path,
+        model_var_pattern=['latent'], is_bass_model=FLAGS.is_bass_model,
+        session_target='')
+
+    axes = LatentGrid.make_axes(
+        FLAGS.grid_size, FLAGS.grid_min, FLAGS.grid_max,
+        dims=config.hparams.encoded_z_size)
+    points = LatentGrid.points(axes)
+    length = config.hparams.max_seq_len
+    logging.info('Decoding %d grid points...', len(points))
+    tensors = np.asarray(model.decode_to_tensors(
+        points, length=length, temperature=FLAGS.temperature))
+
+    grid = LatentGrid.from_tensors(
+        axes, tensors, output_depths_of(config.data_converter),
+        metadata={
+            'config': FLAGS.config,
+            'vae_config': FLAGS.vae_config,
+            'temperature': FLAGS.temperature,
+            'length': length,
+        })
+    grid.save(FLAGS.output_path)
+    logging.info('Saved %s grid to `%s`.', 'x'.join(map(str, grid.grid_shape)),
+                 FLAGS.output_path)
+
+
+def main(unused_argv):
+    """Call grid precomputation function."""
+    logging.set_verbosity(FLAGS.log)
+    run(configs.CONFIG_MAP, vae_configs.CONFIG_MAP)
+
+
+def console_entry_point():
+    """Run entry point."""
+    tf.app.run(main)
+
+
+if __name__ == '__main__':
+    console_entry_point()
@@ -21,9 +21,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import hashlib
+import json
 import os
 import re
+import shutil
 import tarfile
+import threading
 import numpy as np
 
 import tempfile
@@ -45,6 +50,88 @@ def _update_config(config1, config2):
     )
 
 
+DEFAULT_CHECKPOINT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'midime', 'checkpoints')
+
+
+def _is_checkpoint_member(member):
+    """Whether a tar member is a checkpoint file the Saver reads."""
+    name = os.path.normpath(member.name)
+    if os.path.isabs(name) or name.startswith('..'):
+        return False
+    return member.isfile() and (name.endswith('.index') or '.data-' in name)
+
+
+def unbundle_checkpoint(tar_path, cache_dir=None):
+    """Extracts a bundled checkpoint once and returns its checkpoint prefix.
+
+    The extraction is kept in `cache_dir`, keyed by the tarball's path, size and
+    mtime, so later loads restore straight from disk. Only the `.index` and
+    `.data-*` members are extracted. Members are written to a temporary directory
+    that is renamed into place, so an interrupted extraction is never reused.
+
+    Args:
+        tar_path: Path to the checkpoint tarball.
+        cache_dir: Directory to keep extractions in. Defaults to
+            `DEFAULT_CHECKPOINT_CACHE_DIR`.
+    Returns:
+        The path of the extracted checkpoint, without the `.index` suffix.
+    Raises:
+        ValueError: If the tarball contains no `.index` file.
+    """
+    cache_dir = os.path.expanduser(cache_dir or DEFAULT_CHECKPOINT_CACHE_DIR)
+    stat = os.stat(tar_path)
+    key = hashlib.sha1(('%s:%d:%d' % (
+        os.path.abspath(tar_path), stat.st_size, stat.st_mtime_ns)).encode('utf-8')).hexdigest()
+    extract_dir = os.path.join(cache_dir, key)
+
+    if not os.path.isdir(extract_dir):
+        tf.logging.info('Unbundling checkpoint `%s` into `%s`.', tar_path, extract_dir)
+        tf.gfile.MakeDirs(cache_dir)
+        temp_dir = tempfile.mkdtemp(prefix='.%s-' % key, dir=cache_dir)
+        try:
+            with tarfile.open(tar_path) as tar:
+                tar.extractall(temp_dir, members=[
+                    m for m in tar.getmembers() if _is_checkpoint_member(m)])
+            try:
+                os.rename(temp_dir, extract_dir)
+            except OSError:
+                # Another process finished the same extraction first.
+                if not os.path.isdir(extract_dir):
+                    raise
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    else:
+        tf.logging.info('Using unbundled checkpoint `%s`.', extract_dir)
+
+    # Assume only a single checkpoint is in the tarball.
+    for root, _, files in sorted(os.walk(extract_dir)):
+        for name in sorted(files):
+            if name.endswith('.index'):
+                return os.path.join(root, name[0:-6])
+    raise ValueError('No checkpoint found in `%s`.' % tar_path)
+
+
+# Graph transforms applied to exported frozen graphs when available.
+FREEZE_TRANSFORMS = [
+    'remove_nodes(op=CheckNumerics)',
+    'fold_constants(ignore_errors=true)',
+]
+
+
+def frozen_graph_meta_path(frozen_graph_path):
+    """Path of the JSON file describing the tensors of a frozen graph."""
+    return os.path.splitext(frozen_graph_path)[0] + '.json'
+
+
+class NoExtractedExamplesError(Exception):
+    pass
+
+
+class MultipleExtractedExamplesError(Exception):
+    pass
+
+
 class TrainedModel(object):
     """An interface to a trained model for encoding, decoding, and sampling.
 
@@ -54,7 +141,8 @@ class TrainedModel(object):
         batch_size: The batch size to build the model graph with.
         vae_checkpoint_dir_or_path: The directory containing VAE checkpoints for the model,
             the most recent of which will be loaded, or a direct path to a specific
-            checkpoint.
+            checkpoint. If neither checkpoint is given, the variables keep their
+            random initialization (benchmarks).
         model_checkpoint_dir_or_path: The directory containing our
          training checkpoints for the model, the most recent of which will be loaded,
           or a direct path to a specific checkpoint.
@@ -62,6 +150,26 @@ class TrainedModel(object):
          we want to restore from our model.
         session_target: Optional execution engine to connect to. Defaults to
             in-process.
+        intra_op_threads: Size of the session thread pool used inside a single op.
+            0 lets TensorFlow pick.
+        inter_op_threads: Size of the session thread pool used to run independent
+            ops in parallel. 0 lets TensorFlow pick.
+        batch_buckets: Optional list of smaller batch sizes to build decode ops for
+            next to `batch_size`. The decoders need a static batch dimension, so
+            each bucket gets its own sample op sharing the same variables, and
+            decodes run on the smallest bucket that fits instead of padding to
+            `batch_size`.
+        decode_from_z: Whether to also build decode ops fed with full `z_size`
+            vectors, which skip the MidiMe latent decoder and run only the MusicVAE
+            decoder. They share the session and weights of the `encoded_z_size` ops.
+        build_encoder: Whether to build the `encoder/mu` -> `latent_encoder/mu` path
+            used by `encode`, `encode_latent` and `interpolate`. Not available for
+            `is_bass_model`, whose encoder does not match the trio checkpoint.
+        encode_cache_size: Number of encoded NoteSequences kept, keyed by a hash of
+            their content, so re-encoding the same phrase skips the LSTM.
+        checkpoint_cache_dir: Directory bundled (`.tar`) checkpoints are unbundled
+            into and restored from on later loads. Defaults to
+            `DEFAULT_CHECKPOINT_CACHE_DIR`.
         sample_kwargs: Additional, non-tensor keyword arguments to
         pass to sample call.
     """
@@ -69,13 +177,15 @@ class TrainedModel(object):
     def __init__(
             self, vae_config, model_config, batch_size, vae_checkpoint_dir_or_path=None,
             model_checkpoint_dir_or_path=None, model_var_pattern=None, is_bass_model=False,
-            session_target='', **sample_kwargs):
-        if tf.gfile.IsDirectory(vae_checkpoint_dir_or_path):
+            session_target='', intra_op_threads=0, inter_op_threads=0, batch_buckets=None,
+            decode_from_z=False, build_encoder=False, encode_cache_size=32,
+            checkpoint_cache_dir=None, **sample_kwargs):
+        if vae_checkpoint_dir_or_path and tf.gfile.IsDirectory(vae_checkpoint_dir_or_path):
             vae_checkpoint_path = tf.train.latest_checkpoint(vae_checkpoint_dir_or_path)
         else:
             vae_checkpoint_path = vae_checkpoint_dir_or_path
 
-        if tf.gfile.IsDirectory(model_checkpoint_dir_or_path):
+        if model_checkpoint_dir_or_path and tf.gfile.IsDirectory(model_checkpoint_dir_or_path):
             model_checkpoint_path = tf.train.latest_checkpoint(model_checkpoint_dir_or_path)
         else:
             model_checkpoint_path = model_checkpoint_dir_or_path
@@ -94,12 +204,6 @@ class TrainedModel(object):
             # Input placeholders
             self._temperature = tf.placeholder(tf.float32, shape=())
 
-            if self._config.hparams.z_size:
-                self._latent_z_input = tf.placeholder(
-                    tf.float32, shape=[batch_size, self._config.hparams.encoded_z_size])
-            else:
-                self._latent_z_input = None
-
             if self._config.data_converter.control_depth > 0:
                 self._c_input = tf.placeholder(
                     tf.float32, shape=[None, self._config.data_converter.control_depth])
@@ -117,20 +221,75 @@ class TrainedModel(object):
                 shape=[batch_size] + list(self._config.data_converter.length_shape))
             self._max_length = tf.placeholder(tf.int32, shape=())
 
-            # Outputs
-            self._outputs, self._decoder_results = model.sample(
-                batch_size,
-                max_length=self._max_length,
-                latent_z=self._latent_z_input,
-                c_input=self._c_input,
-                temperature=self._temperature,
-                **sample_kwargs)
+            # Outputs, one sample op per batch bucket. The largest one is built
+            # first and creates the variables, the others reuse them.
+            self._buckets = sorted(
+                {b for b in batch_buckets or [] if 0 < b < batch_size} | {batch_size},
+                reverse=True)
+            self._latent_z_inputs = {}
+            self._bucket_outputs = {}
+            self._bucket_decoder_results = {}
+            for bucket in self._buckets:
+                with tf.variable_scope(tf.get_variable_scope(),
+                                       reuse=True if bucket != batch_size else None):
+                    # Hierarchical decoders read the batch size from hparams.
+                    self._config.hparams.batch_size = bucket
+                    if self._config.hparams.z_size:
+                        self._latent_z_inputs[bucket] = tf.placeholder(
+                            tf.float32, shape=[bucket, self._config.hparams.encoded_z_size])
+                    else:
+                        self._latent_z_inputs[bucket] = None
+                    (self._bucket_outputs[bucket],
+                     self._bucket_decoder_results[bucket]) = model.sample(
+                         bucket,
+                         max_length=self._max_length,
+                         latent_z=self._latent_z_inputs[bucket],
+                         c_input=self._c_input,
+                         temperature=self._temperature,
+                         **sample_kwargs)
+
+            # Decode-only outputs fed with full `z`, sharing the variables above.
+            self._z_inputs = {}
+            self._bucket_z_outputs = {}
+            self._bucket_z_decoder_results = {}
+            if decode_from_z and self._config.hparams.z_size:
+                for bucket in self._buckets:
+                    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+                        self._config.hparams.batch_size = bucket
+                        self._z_inputs[bucket] = tf.placeholder(
+                            tf.float32, shape=[bucket, self._config.hparams.z_size])
+                        (self._bucket_z_outputs[bucket],
+                         self._bucket_z_decoder_results[bucket]) = model.sample_from_z(
+                             bucket,
+                             max_length=self._max_length,
+                             z=self._z_inputs[bucket],
+                             c_input=self._c_input,
+                             temperature=self._temperature,
+                             **sample_kwargs)
+            self._config.hparams.batch_size = batch_size
+            self._buckets.reverse()
+            self._latent_z_input = self._latent_z_inputs[batch_size]
+            self._outputs = self._bucket_outputs[batch_size]
+            self._decoder_results = self._bucket_decoder_results[batch_size]
+
+            # Encoder: sequence -> z (MusicVAE) -> z' (MidiMe)
+            self._encode_cache = collections.OrderedDict()
+            self._encode_cache_size = encode_cache_size
+            self._encode_lock = threading.Lock()
+            if build_encoder and self._config.hparams.z_size and not is_bass_model:
+                q_z = model.encode(self._inputs, self._inputs_length, self._controls)
+                self._mu = q_z.loc
+                self._sigma = q_z.scale.diag
+                self._z = q_z.sample()
+                self._latent_mu = model.encode_latent(self._mu).loc
+            else:
+                self._z = None
 
             vae_var_list = []
             model_var_list = []
             for v in tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES):
                 flag = False
-                for pattern in model_var_pattern:
+                for pattern in model_var_pattern or []:
                     if re.search(pattern, v.name):
                         flag = True
                         model_var_list.append(v)
@@ -146,40 +305,120 @@ class TrainedModel(object):
                         vae_var_list.append(v)
 
             # Restore vae graph part
-            self._sess = tf.Session(target=session_target)
-            if is_bass_model:
+            session_config = tf.ConfigProto(
+                intra_op_parallelism_threads=intra_op_threads,
+                inter_op_parallelism_threads=inter_op_threads)
+            self._sess = tf.Session(target=session_target, config=session_config)
+            # Without checkpoints the random weights are kept, e.g. for benchmarks.
+            random_init = vae_checkpoint_path is None and model_checkpoint_path is None
+            if is_bass_model or random_init:
                 self._sess.run(tf.global_variables_initializer())
-            
+            if random_init:
+                return
+
             vae_saver = tf.train.Saver(vae_var_list)
             if os.path.exists(vae_checkpoint_path) and tarfile.is_tarfile(vae_checkpoint_path):
-                tf.logging.info('Unbundling vae checkpoint.')
-                with tempfile.TemporaryDirectory() as temp_dir:
-                    tar = tarfile.open(vae_checkpoint_path)
-                    tar.extractall(temp_dir)
-                    # Assume only a single checkpoint is in the directory.
-                    for name in tar.getnames():
-                        if name.endswith('.index'):
-                            vae_checkpoint_path = os.path.join(temp_dir, name[0:-6])
-                            break
-                    vae_saver.restore(self._sess, vae_checkpoint_path)
-            else:
-                vae_saver.restore(self._sess, vae_checkpoint_path)
+                vae_checkpoint_path = unbundle_checkpoint(vae_checkpoint_path, checkpoint_cache_dir)
+            vae_saver.restore(self._sess, vae_checkpoint_path)
 
             # Restore model graph part
             model_saver = tf.train.Saver(model_var_list)
             if os.path.exists(model_checkpoint_path) and tarfile.is_tarfile(model_checkpoint_path):
-                tf.logging.info('Unbundling model checkpoint.')
-                with tempfile.TemporaryDirectory() as temp_dir:
-                    tar = tarfile.open(model_checkpoint_path)
-                    tar.extractall(temp_dir)
-                    # Assume only a single checkpoint is in the directory.
-                    for name in tar.getnames():
-                        if name.endswith('.index'):
-                            model_checkpoint_path = os.path.join(temp_dir, name[0:-6])
-                            break
-                    model_saver.restore(self._sess, model_checkpoint_path)
-            else:
-                model_saver.restore(self._sess, model_checkpoint_path)
+                model_checkpoint_path = unbundle_checkpoint(
+                    model_checkpoint_path, checkpoint_cache_dir)
+            model_saver.restore(self._sess, model_checkpoint_path)
+
+    @property
+    def batch_size(self):
+        """The number of rows every `sess.run` of the model graph decodes."""
+        return self._config.hparams.batch_size
+
+    @property
+    def z_size(self):
+        """Size of the MusicVAE latent vector."""
+        return self._config.hparams.z_size
+
+    @property
+    def encoded_z_size(self):
+        """Size of the MidiMe latent vector."""
+        return self._config.hparams.encoded_z_size
+
+    @property
+    def batch_buckets(self):
+        """Batch sizes decode ops were built for, in ascending order."""
+        return list(self._buckets)
+
+    @property
+    def can_decode_z(self):
+        """Whether `decode_z` is available (built with `decode_from_z`)."""
+        return bool(self._z_inputs)
+
+    def _signature(self):
+        """Maps a stable name to every input and output tensor used for inference."""
+        tensors = {'temperature': self._temperature, 'max_length': self._max_length}
+        if self._c_input is not None:
+            tensors['c_input'] = self._c_input
+        for bucket in self._buckets:
+            if self._latent_z_inputs[bucket] is not None:
+                tensors['latent_z/%d' % bucket] = self._latent_z_inputs[bucket]
+            tensors['output/%d' % bucket] = self._bucket_outputs[bucket]
+            if bucket in self._z_inputs:
+                tensors['z/%d' % bucket] = self._z_inputs[bucket]
+                tensors['z_output/%d' % bucket] = self._bucket_z_outputs[bucket]
+        if self._z is not None:
+            tensors.update(inputs=self._inputs, controls=self._controls,
+                           inputs_length=self._inputs_length, z=self._z, mu=self._mu,
+                           sigma=self._sigma, latent_mu=self._latent_mu)
+        return tensors
+
+    def export_frozen_graph(self, output_path, metadata=None, transforms=None):
+        """Writes the restored inference graph with its variables folded into constants.
+
+        Only the ops needed by the decode (and encode, if built) tensors are kept, so
+        the training decoder, the Savers and the variable initializers are dropped,
+        and the `is_bass_model` renaming is baked in. `FREEZE_TRANSFORMS` are then
+        applied if `tensorflow.tools.graph_transforms` is available. Tensor names are
+        written next to the graph as JSON for `FrozenTrainedModel`.
+
+        Args:
+          output_path: Path of the `.pb` file to write.
+          metadata: Optional dictionary stored in the JSON file along the tensors.
+          transforms: Graph transforms to apply, `FREEZE_TRANSFORMS` if not given.
+        Returns:
+          The frozen GraphDef.
+        """
+        tensors = self._signature()
+        input_nodes = sorted({t.op.name for t in tensors.values() if t.op.type == 'Placeholder'})
+        output_nodes = sorted({t.op.name for t in tensors.values()} - set(input_nodes))
+
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            self._sess, self._sess.graph.as_graph_def(), input_nodes + output_nodes)
+        try:
+            from tensorflow.tools.graph_transforms import TransformGraph  # pylint: disable=import-error
+        except ImportError:
+            tf.logging.warning('Graph transforms not available, writing the graph as is.')
+        else:
+            graph_def = TransformGraph(graph_def, input_nodes, output_nodes,
+                                       FREEZE_TRANSFORMS if transforms is None else transforms)
+
+        with tf.gfile.GFile(output_path, 'wb') as f:
+            f.write(graph_def.SerializeToString())
+        meta = dict(metadata or {})
+        meta.update(batch_size=self._config.hparams.batch_size,
+                    buckets=self._buckets,
+                    tensors={k: t.name for k, t in tensors.items()})
+        with tf.gfile.GFile(frozen_graph_meta_path(output_path), 'w') as f:
+            json.dump(meta, f, indent=2, sort_keys=True)
+        tf.logging.info('Exported frozen graph with %d nodes to `%s`.',
+                        len(graph_def.node), output_path)
+        return graph_def
+
+    def _bucket_for(self, n):
+        """Smallest prebuilt batch bucket holding `n` rows, else the largest one."""
+        for bucket in self._buckets:
+            if bucket >= n:
+                return bucket
+        return self._buckets[-1]
 
     def sample(self, n=None, length=None, temperature=1.0, same_latent_z=False, c_input=None):
         """
@@ -211,21 +450,26 @@ class TrainedModel(object):
             self._max_length: length
         }
 
+        same_z = None
         if self._latent_z_input is not None and same_latent_z:
-            latent_z = np.random.randn(latent_z_size).astype(np.float32)
-            latent_z = np.tile(latent_z, (batch_size, 1))
-            feed_dict[self._latent_z_input] = latent_z
+            same_z = np.random.randn(latent_z_size).astype(np.float32)
 
         if self._c_input is not None:
             feed_dict[self._c_input] = c_input
 
         outputs = []
-        for _ in range(int(np.ceil(n / batch_size))):
-            if self._latent_z_input is not None and not same_latent_z:
-                feed_dict[self._latent_z_input] = (
-                    np.random.randn(batch_size, latent_z_size).astype(np.float32)
+        remaining = n
+        while remaining > 0:
+            bucket = self._bucket_for(remaining)
+            latent_z_input = self._latent_z_inputs[bucket]
+            if latent_z_input is not None and same_z is not None:
+                feed_dict[latent_z_input] = np.tile(same_z, (bucket, 1))
+            elif latent_z_input is not None:
+                feed_dict[latent_z_input] = (
+                    np.random.randn(bucket, latent_z_size).astype(np.float32)
                 )
-            outputs.append(self._sess.run(self._outputs, feed_dict))
+            outputs.append(self._sess.run(self._bucket_outputs[bucket], feed_dict))
+            remaining -= bucket
         samples = np.vstack(outputs)[:n]
         if self._c_input is not None:
             return self._config.data_converter.from_tensors(
@@ -234,6 +478,170 @@ class TrainedModel(object):
 
         return self._config.data_converter.from_tensors(samples)
 
+    def encode(self, note_sequences, assert_same_length=False):
+        """Encodes a collection of NoteSequences into latent vectors.
+
+        Sequences encoded before are answered from the encode cache, the others
+        are encoded together in as few batches as possible.
+
+        Args:
+          note_sequences: A collection of NoteSequence objects to encode.
+          assert_same_length: Whether to raise an AssertionError if all of the
+            extracted sequences are not the same length.
+        Returns:
+          The encoded `z`, `mu`, and `sigma` values of the MusicVAE latent space.
+        Raises:
+          RuntimeError: If the model was built without the encoder.
+          NoExtractedExamplesError: If no examples were extracted.
+          MultipleExtractedExamplesError: If multiple examples were extracted.
+          AssertionError: If `assert_same_length` is True and any extracted
+            sequences differ in length.
+        """
+        z, mu, sigma, _ = self._encode_cached(note_sequences, assert_same_length)
+        return z, mu, sigma
+
+    def encode_latent(self, note_sequences, assert_same_length=False):
+        """Encodes a collection of NoteSequences into the small MidiMe latent space.
+
+        Returns:
+          The `latent_encoder/mu` values, sized `[n, encoded_z_size]`.
+        """
+        return self._encode_cached(note_sequences, assert_same_length)[3]
+
+    def _encode_cached(self, note_sequences, assert_same_length=False):
+        if self._z is None:
+            raise RuntimeError('Cannot encode, the model was built without the encoder.')
+
+        keys = [hashlib.sha1(ns.SerializeToString(deterministic=True)).hexdigest()
+                for ns in note_sequences]
+        # Hits are read and touched before any miss is inserted, so inserting
+        # cannot evict a hit of the same call.
+        encoded = {}
+        with self._encode_lock:
+            for key in keys:
+                if key in self._encode_cache:
+                    self._encode_cache.move_to_end(key)
+                    encoded[key] = self._encode_cache[key]
+        missing = [i for i, key in enumerate(keys) if key not in encoded]
+
+        inputs = []
+        controls = []
+        lengths = []
+        for i in missing:
+            extracted_tensors = self._config.data_converter.to_tensors(note_sequences[i])
+            if not extracted_tensors.inputs:
+                raise NoExtractedExamplesError(
+                    'No examples extracted from NoteSequence: %s' % note_sequences[i])
+            if len(extracted_tensors.inputs) > 1:
+                raise MultipleExtractedExamplesError(
+                    'Multiple (%d) examples extracted from NoteSequence: %s' %
+                    (len(extracted_tensors.inputs), note_sequences[i]))
+            inputs.append(extracted_tensors.inputs[0])
+            controls.append(extracted_tensors.controls[0])
+            lengths.append(extracted_tensors.lengths[0])
+            if assert_same_length and len(inputs[0]) != len(inputs[-1]):
+                raise AssertionError(
+                    'Sequences 0 and %d have different lengths: %d vs %d' %
+                    (len(inputs) - 1, len(inputs[0]), len(inputs[-1])))
+
+        if missing:
+            results = self.encode_tensors(inputs, lengths, controls)
+            with self._encode_lock:
+                for row, i in enumerate(missing):
+                    encoded[keys[i]] = tuple(v[row] for v in results)
+                    self._encode_cache[keys[i]] = encoded[keys[i]]
+                    self._encode_cache.move_to_end(keys[i])
+                while len(self._encode_cache) > self._encode_cache_size:
+                    self._encode_cache.popitem(last=False)
+        return tuple(np.stack(v) for v in zip(*[encoded[key] for key in keys]))
+
+    def encode_tensors(self, input_tensors, lengths, control_tensors=None):
+        """Encodes a collection of input tensors into latent vectors.
+
+        Args:
+          input_tensors: Collection of input tensors to encode.
+          lengths: Collection of lengths of input tensors.
+          control_tensors: Collection of control tensors to encode.
+        Returns:
+          The encoded `z`, `mu`, `sigma` and `latent_encoder/mu` values.
+        Raises:
+          RuntimeError: If the model was built without the encoder.
+        """
+        if self._z is None:
+            raise RuntimeError('Cannot encode, the model was built without the encoder.')
+
+        n = len(input_tensors)
+        input_depth = self._config.data_converter.input_depth
+        batch_size = self._config.hparams.batch_size
+
+        batch_pad_amt = -n % batch_size
+        input_tensors = list(input_tensors) + [np.zeros([0, input_depth])] * batch_pad_amt
+        length_array = np.array(lengths, np.int32)
+        length_array = np.pad(
+            length_array,
+            [(0, batch_pad_amt)] + [(0, 0)] * (length_array.ndim - 1),
+            'constant')
+
+        max_length = max([len(t) for t in input_tensors])
+        inputs_array = np.zeros([len(input_tensors), max_length, input_depth])
+        for i, t in enumerate(input_tensors):
+            inputs_array[i, :len(t)] = t
+
+        control_depth = self._config.data_converter.control_depth
+        controls_array = np.zeros([len(input_tensors), max_length, control_depth])
+        if control_tensors is not None:
+            for i, t in enumerate(control_tensors):
+                controls_array[i, :len(t)] = t
+
+        outputs = []
+        for i in range(len(inputs_array) // batch_size):
+            batch_begin = i * batch_size
+            batch_end = (i + 1) * batch_size
+            feed_dict = {self._inputs: inputs_array[batch_begin:batch_end],
+                         self._controls: controls_array[batch_begin:batch_end],
+                         self._inputs_length: length_array[batch_begin:batch_end]}
+            outputs.append(self._sess.run(
+                [self._z, self._mu, self._sigma, self._latent_mu], feed_dict))
+        return tuple(np.vstack(v)[:n] for v in zip(*outputs))
+
+    def interpolate(self, start_sequence, end_sequence, num_steps,
+                    length=None, temperature=1.0, assert_same_length=True):
+        """Interpolates between a start and an end NoteSequence.
+
+        Interpolates the MusicVAE `mu` when the model was built with
+        `decode_from_z`, otherwise the MidiMe `latent_encoder/mu`.
+
+        Args:
+          start_sequence: The NoteSequence to interpolate from.
+          end_sequence: The NoteSequence to interpolate to.
+          num_steps: Number of NoteSequences to be generated, including the
+            reconstructions of the start and end sequences.
+          length: The maximum length of a sample in decoder iterations. Required
+            if end tokens are not being used.
+          temperature: The softmax temperature to use (if applicable).
+          assert_same_length: Whether to raise an AssertionError if all of the
+            extracted sequences are not the same length.
+        Returns:
+          A list of interpolated NoteSequences.
+        """
+        def _slerp(p0, p1, t):
+            """Spherical linear interpolation."""
+            omega = np.arccos(np.clip(np.dot(np.squeeze(p0 / np.linalg.norm(p0)),
+                                             np.squeeze(p1 / np.linalg.norm(p1))), -1.0, 1.0))
+            so = np.sin(omega)
+            if so == 0:
+                return (1.0 - t) * p0 + t * p1
+            return np.sin((1.0 - t) * omega) / so * p0 + np.sin(t * omega) / so * p1
+
+        _, mu, _, latent_mu = self._encode_cached(
+            [start_sequence, end_sequence], assert_same_length)
+        if self._z_inputs:
+            z = np.array([_slerp(mu[0], mu[1], t) for t in np.linspace(0, 1, num_steps)])
+            return self.decode_z(z, length=length, temperature=temperature)
+        latent_z = np.array([_slerp(latent_mu[0], latent_mu[1], t)
+                             for t in np.linspace(0, 1, num_steps)])
+        return self.decode(latent_z, length=length, temperature=temperature)
+
     def decode(self, z, length=None, temperature=1.0, c_input=None):
         """Decodes a collection of latent vectors into NoteSequences.
         
@@ -251,6 +659,21 @@ class TrainedModel(object):
             used.
         """
         tensors = self.decode_to_tensors(z, length, temperature, c_input)
+        return self._tensors_to_sequences(tensors, c_input)
+
+    def decode_z(self, z, length=None, temperature=1.0, c_input=None):
+        """Decodes a collection of full MusicVAE `z` vectors into NoteSequences.
+
+        Same as `decode`, but `z` is sized `[n, z_size]` and only the MusicVAE
+        decoder runs.
+
+        Raises:
+          RuntimeError: If the model was built without `decode_from_z`.
+        """
+        tensors = self.decode_z_to_tensors(z, length, temperature, c_input)
+        return self._tensors_to_sequences(tensors, c_input)
+
+    def _tensors_to_sequences(self, tensors, c_input=None):
         if self._c_input is not None:
           return self._config.data_converter.from_tensors(
               tensors,
@@ -280,30 +703,135 @@ class TrainedModel(object):
           ValueError: If `length` is not specified and an end token is not being
             used.
         """
+        return self._run_decode(
+            self._latent_z_inputs, self._bucket_outputs, self._bucket_decoder_results,
+            z, length, temperature, c_input, return_full_results)
+
+    def decode_z_to_tensors(self, z, length=None, temperature=1.0, c_input=None,
+                            return_full_results=False):
+        """Decodes a collection of full MusicVAE `z` vectors into output tensors.
+
+        Same as `decode_to_tensors`, but `z` is sized `[n, z_size]` and the MidiMe
+        latent decoder is skipped.
+
+        Raises:
+          RuntimeError: If the model was built without `decode_from_z`.
+        """
+        if not self._z_inputs:
+          raise RuntimeError(
+              'Cannot decode full `z`, the model was built without `decode_from_z`.')
+        return self._run_decode(
+            self._z_inputs, self._bucket_z_outputs, self._bucket_z_decoder_results,
+            z, length, temperature, c_input, return_full_results)
+
+    def _run_decode(self, inputs, bucket_outputs, bucket_decoder_results, z,
+                    length, temperature, c_input, return_full_results):
+        """Runs `z` through the given per-bucket decode ops."""
         if not self._config.hparams.z_size:
           raise RuntimeError('Cannot decode with a non-conditional model.')
 
         if not length and self._config.data_converter.end_token is None:
           raise ValueError(
               'A length must be specified when the end token is not used.')
-        batch_size = self._config.hparams.batch_size
         n = len(z)
         length = length or tf.int32.max
 
-        batch_pad_amt = -n % batch_size
-        z = np.pad(z, [(0, batch_pad_amt), (0, 0)], mode='constant')
-
         outputs = []
-        for i in range(len(z) // batch_size):
+        begin = 0
+        while begin < n:
+          bucket = self._bucket_for(n - begin)
+          batch_z = z[begin:begin + bucket]
+          batch_z = np.pad(
+              batch_z, [(0, bucket - len(batch_z)), (0, 0)], mode='constant')
           feed_dict = {
               self._temperature: temperature,
-              self._latent_z_input: z[i*batch_size:(i+1)*batch_size],
+              inputs[bucket]: batch_z,
               self._max_length: length,
           }
           if self._c_input is not None:
             feed_dict[self._c_input] = c_input
           if return_full_results:
-            outputs.extend(self._sess.run(self._decoder_results, feed_dict))
+            outputs.extend(self._sess.run(bucket_decoder_results[bucket], feed_dict))
           else:
-            outputs.extend(self._sess.run(self._outputs, feed_dict))
+            outputs.extend(self._sess.run(bucket_outputs[bucket], feed_dict)[:n - begin])
+          begin += bucket
         return outputs[:n]
+
+
+class FrozenTrainedModel(TrainedModel):
+    """A `TrainedModel` served from a graph written by `export_frozen_graph`.
+
+    No model is built and no checkpoint is restored, the frozen GraphDef is
+    imported as is. Buckets, the full `z` decode ops and the encoder are available
+    if they were built when the graph was exported.
+
+    Args:
+        vae_config: The Config the graph was exported with, used for its hparams.
+        model_config: The MidiMe Config the graph was exported with, used for its
+            data converter.
+        frozen_graph_path: Path of the `.pb` file. The JSON file written next to it
+            by `export_frozen_graph` is read as well.
+        session_target: Optional execution engine to connect to. Defaults to
+            in-process.
+        intra_op_threads: Size of the session thread pool used inside a single op.
+            0 lets TensorFlow pick.
+        inter_op_threads: Size of the session thread pool used to run independent
+            ops in parallel. 0 lets TensorFlow pick.
+        encode_cache_size: Number of encoded NoteSequences kept.
+    """
+
+    def __init__(self, vae_config, model_config, frozen_graph_path, session_target='',
+                 intra_op_threads=0, inter_op_threads=0, encode_cache_size=32):
+        with tf.gfile.GFile(frozen_graph_meta_path(frozen_graph_path)) as f:
+            meta = json.load(f)
+        self._config = _update_config(model_config, vae_config)
+        self._config.data_converter.set_mode('infer')
+        self._config.hparams.batch_size = meta['batch_size']
+
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(frozen_graph_path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        tensors = {k: graph.get_tensor_by_name(v) for k, v in meta['tensors'].items()}
+
+        self._temperature = tensors['temperature']
+        self._max_length = tensors['max_length']
+        self._c_input = tensors.get('c_input')
+        self._buckets = sorted(meta['buckets'])
+        self._latent_z_inputs = {b: tensors.get('latent_z/%d' % b) for b in self._buckets}
+        self._bucket_outputs = {b: tensors['output/%d' % b] for b in self._buckets}
+        self._bucket_decoder_results = {}
+        self._z_inputs = {b: tensors['z/%d' % b] for b in self._buckets
+                          if 'z/%d' % b in tensors}
+        self._bucket_z_outputs = {b: tensors['z_output/%d' % b] for b in self._z_inputs}
+        self._bucket_z_decoder_results = {}
+        self._latent_z_input = self._latent_z_inputs[meta['batch_size']]
+        self._outputs = self._bucket_outputs[meta['batch_size']]
+        self._decoder_results = None
+
+        self._encode_cache = collections.OrderedDict()
+        self._encode_cache_size = encode_cache_size
+        self._encode_lock = threading.Lock()
+        self._z = tensors.get('z')
+        if self._z is not None:
+            self._inputs = tensors['inputs']
+            self._controls = tensors['controls']
+            self._inputs_length = tensors['inputs_length']
+            self._mu = tensors['mu']
+            self._sigma = tensors['sigma']
+            self._latent_mu = tensors['latent_mu']
+
+        session_config = tf.ConfigProto(
+            intra_op_parallelism_threads=intra_op_threads,
+            inter_op_parallelism_threads=inter_op_threads)
+        self._sess = tf.Session(target=session_target, graph=graph, config=session_config)
+
+    def _run_decode(self, inputs, bucket_outputs, bucket_decoder_results, z,
+                    length, temperature, c_input, return_full_results):
+        if return_full_results:
+          raise RuntimeError('A frozen graph only exports the decoder samples.')
+        return super(FrozenTrainedModel, self)._run_decode(
+            inputs, bucket_outputs, bucket_decoder_results, z,
+            length, temperature, c_input, return_full_results)
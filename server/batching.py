@@ -0,0 +1,162 @@
+import collections
+import threading
+import time
+from concurrent.futures import Future
+from logging import debug, warn
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+DecodeRequest = collections.namedtuple(
+    "DecodeRequest", ["z", "length", "temperature", "future"])
+
+
+def axis_neighbours(z: np.ndarray, n: int, radius: float) -> np.ndarray:
+    """ up to `n` points at +-radius along each latent axis around z """
+    z = np.asarray(z, dtype=np.float32).reshape(-1)
+    offsets = np.concatenate([np.eye(z.shape[0]), -np.eye(z.shape[0])])
+    return (z + radius * offsets[:n]).astype(np.float32)
+
+
+class MicroBatchDecoder:
+    """ packs decode requests arriving within `window_sec` into one `sess.run`.
+
+    `TrainedModel` always runs a full batch of `batch_size` rows, so a lone
+    live request pays for the padding rows too. requests that share length
+    and temperature (they are scalar feeds of the graph) are collected and
+    decoded together, and the results are scattered back through futures.
+    rows that would still be padding can be spent on points around the
+    requested z (`speculative_radius`), which are handed to `on_speculative`
+    so that they can be put into a decode cache. `spare_rows(z, n)` can
+    supply up to n better guesses for those rows (e.g. a trajectory
+    prediction), the neighbours fill the rest.
+    """
+
+    def __init__(self, model, window_sec: float = 0.005,
+                 speculative_radius: float = 0.0,
+                 on_speculative: Optional[Callable[[np.ndarray, np.ndarray, int, float], None]] = None,
+                 spare_rows: Optional[Callable[[np.ndarray, int], np.ndarray]] = None
+                 ) -> None:
+        self.model = model
+        self.batch_size: int = model.batch_size
+        self.window_sec = window_sec
+        self.speculative_radius = speculative_radius
+        self.on_speculative = on_speculative
+        self.spare_rows = spare_rows
+
+        self.batches = 0
+        self.requests = 0
+        self.speculative = 0
+
+        self._queue: List[DecodeRequest] = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="micro-batch-decoder", daemon=True)
+        self._thread.start()
+
+    def submit(self, z: np.ndarray, length: Optional[int],
+               temperature: float = 1.0) -> Future:
+        """ queues one latent vector and returns a future of its output tensor """
+        future: Future = Future()
+        request = DecodeRequest(np.asarray(z, dtype=np.float32).reshape(-1),
+                                length, temperature, future)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("MicroBatchDecoder is closed")
+            self._queue.append(request)
+            self._cond.notify_all()
+        return future
+
+    def decode_to_tensors(self, z: np.ndarray, length: Optional[int],
+                          temperature: float = 1.0) -> List[np.ndarray]:
+        """ blocking counterpart of `TrainedModel.decode_to_tensors` """
+        z = np.asarray(z, dtype=np.float32)
+        futures = [self.submit(row, length, temperature)
+                   for row in z.reshape(-1, z.shape[-1])]
+        return [f.result() for f in futures]
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def stats(self) -> Dict[str, float]:
+        with self._cond:
+            return {"batches": self.batches,
+                    "requests": self.requests,
+                    "speculative": self.speculative,
+                    "rows_per_batch": (self.requests + self.speculative) / self.batches
+                    if self.batches else 0.0}
+
+    def _collect(self) -> List[DecodeRequest]:
+        with self._cond:
+            self._cond.wait_for(lambda: self._closed or self._queue)
+            if not self._queue:
+                return []
+            deadline = time.monotonic() + self.window_sec
+            while len(self._queue) < self.batch_size and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            requests, self._queue = self._queue, []
+            return requests
+
+    def _run(self) -> None:
+        while True:
+            requests = self._collect()
+            if not requests:
+                return
+            groups: Dict[Tuple, List[DecodeRequest]] = collections.defaultdict(list)
+            for r in requests:
+                # z' and full z rows run through different decode ops
+                groups[(r.length, r.temperature, r.z.shape[0])].append(r)
+            for (length, temperature, _), group in groups.items():
+                for i in range(0, len(group), self.batch_size):
+                    self._decode_batch(group[i:i + self.batch_size], length, temperature)
+
+    def _spare_rows(self, z: np.ndarray, n: int) -> np.ndarray:
+        rows = np.empty((0, z.shape[0]), np.float32)
+        if self.spare_rows is not None:
+            try:
+                rows = np.asarray(self.spare_rows(z, n), np.float32).reshape(-1, z.shape[0])[:n]
+            except Exception as e:
+                warn(f"Failed to get spare rows: {e}")
+        if len(rows) < n and self.speculative_radius > 0:
+            rows = np.concatenate(
+                [rows, axis_neighbours(z, n - len(rows), self.speculative_radius)])
+        return rows
+
+    def _decode_batch(self, batch: List[DecodeRequest], length: Optional[int],
+                      temperature: float) -> None:
+        z = np.stack([r.z for r in batch])
+        n_spare = self.batch_size - len(batch)
+        if n_spare > 0 and self.on_speculative:
+            z = np.concatenate([z, self._spare_rows(batch[-1].z, n_spare)])
+        try:
+            if z.shape[1] == self.model.z_size:
+                outputs = self.model.decode_z_to_tensors(z, length, temperature)
+            else:
+                outputs = self.model.decode_to_tensors(z, length, temperature)
+        except Exception as e:
+            warn(f"Failed to decode batch of {len(batch)}: {e}")
+            for r in batch:
+                r.future.set_exception(e)
+            return
+
+        for r, output in zip(batch, outputs):
+            r.future.set_result(output)
+        for spec_z, output in zip(z[len(batch):], outputs[len(batch):]):
+            try:
+                self.on_speculative(spec_z, output, length, temperature)
+            except Exception as e:
+                warn(f"Failed to store speculative decode: {e}")
+
+        with self._cond:
+            self.batches += 1
+            self.requests += len(batch)
+            self.speculative += len(outputs) - len(batch)
+        debug(f"decoded batch of {len(batch)} (+{len(outputs) - len(batch)} speculative)")
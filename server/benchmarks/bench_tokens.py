@@ -0,0 +1,69 @@
+""" compares the M4L token serializer against the previous per-note version
+
+usage (from server/): python benchmarks/bench_tokens.py
+"""
+import argparse
+import collections
+import os
+import sys
+import timeit
+
+import numpy as np
+from note_seq.protobuf import music_pb2
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from tokens import note_matrix_to_tokens, note_sequence_to_matrix
+
+# notes of a dense output: 2 bars of 16th notes, 16 bars of trio (drums, mel, bass)
+CASES = {"2bar": 32, "16bar_trio": 16 * 16 * 3}
+
+
+def legacy_note_sequence_to_tokens_for_M4L(seq) -> str:
+    """ `note_sequence_to_tokens_for_M4L` before it was vectorized """
+    output_data = ""
+    maped_output = None
+    output_midi = collections.defaultdict(list)
+    for seq_note in seq.notes:
+        start_time = seq_note.start_time * 1000
+        end_time = seq_note.end_time * 1000
+        output_midi['notes'].append([seq_note.pitch, seq_note.velocity, '{:.2f}'.format(
+            start_time), '{:.2f}'.format(end_time)])
+        maped_output = map(
+            str, sum(output_midi['notes'], []))
+        output_data = ' '.join(maped_output)
+    return output_data
+
+
+def random_sequence(n: int, seed: int = 0) -> music_pb2.NoteSequence:
+    rng = np.random.RandomState(seed)
+    seq = music_pb2.NoteSequence()
+    for i in range(n):
+        start = i * 0.125 + rng.uniform(0, 0.01)
+        seq.notes.add(pitch=int(rng.randint(21, 109)), velocity=80,
+                      start_time=start, end_time=start + 0.125 * rng.randint(1, 4))
+    return seq
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args()
+
+    for name, n in CASES.items():
+        seq = random_sequence(n)
+        legacy = legacy_note_sequence_to_tokens_for_M4L(seq)
+        assert note_matrix_to_tokens(note_sequence_to_matrix(seq)) == legacy, name
+        results = {}
+        for label, func in [
+                ("legacy", lambda: legacy_note_sequence_to_tokens_for_M4L(seq)),
+                ("vectorized", lambda: note_matrix_to_tokens(note_sequence_to_matrix(seq)))]:
+            best = min(timeit.repeat(func, repeat=args.repeat, number=args.number))
+            results[label] = best / args.number * 1000
+        print(f"{name:>11} ({n:4d} notes): legacy {results['legacy']:8.3f} ms, "
+              f"vectorized {results['vectorized']:8.3f} ms, "
+              f"x{results['legacy'] / results['vectorized']:.1f}")
+
+
+if __name__ == "__main__":
+    main()
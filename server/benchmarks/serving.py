@@ -0,0 +1,356 @@
+""" end-to-end serving benchmark: OSC z in, /generated_notes_* out
+
+starts the pipeline of main.py (OSCServer, ReceivedNotesManager, event
+handlers, OSCSender) on local UDP ports, replays `/z_drums`, `/z_mel` and
+`/z_bass` gestures at a fixed rate and reports, per mode, the throughput,
+end-to-end latency percentiles and the share of z that never got a reply.
+
+`--model stub` replaces MusicVAEModel by `StubModel`, which sleeps instead of
+running a session, so the serving layer can be measured on any CPU box
+without checkpoints, TF or config.yml (only `--model real` imports
+generator). the stub writes z back into the start times of the first three
+notes, which lets every reply be matched to the z it answers even when
+stale z are dropped (`--coalesce`). replies of the real models are matched to
+the requests in order, which is only exact without `--coalesce`.
+
+recorded streams are text files of `seconds address x y z` lines, e.g.
+`0.033 /z_mel 0.1200 -0.3400 0.5600`; `--save_stream` writes the synthetic
+stream in that format.
+
+usage (from server/):
+    python benchmarks/serving.py --rate 30 --duration 10 --stub_decode_ms 20,40,150
+    python benchmarks/serving.py --coalesce --per_mode_workers --rate 120
+    python benchmarks/serving.py --model real --replay gestures.txt --json result.json
+"""
+import argparse
+import collections
+import contextlib
+import json
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+from note_seq.protobuf import music_pb2
+from pythonosc import udp_client
+from pythonosc.dispatcher import Dispatcher
+from pythonosc.osc_server import ThreadingOSCUDPServer
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from converter import ReceivedNotesManager
+from event_handlers import on_output_note_sequence_func
+from metrics import METRICS
+from midi_writer import MidiWriter, write_midi_durable
+from osc import PAYLOAD_FORMATS, OSCSender, OSCServer
+from phrase import Phrase
+
+MODES = ("drums", "mel", "bass")
+# (vae config, MidiMe config) of the models main.py serves
+MODEL_CONFIGS = {"drums": ("cat-drums_2bar_small", "cat-drums_2bar_small_3dim"),
+                 "mel": ("cat-mel_2bar_big", "cat-mel_2bar_big_3dim"),
+                 "bass": ("hierdec-trio_16bar", "hierdec-trio_16bar_3dim")}
+# z is sent with this many decimals and matched on them
+Z_DECIMALS = 4
+
+# one z of the load: when to send it, where and the `x y z` coordinate
+Event = Tuple[float, str, Tuple[float, float, float]]
+
+
+class StubModel:
+    """ stands in for `MusicVAEModel` without TF.
+
+    a decode sleeps `decode_ms` per batch, as one `sess.run` would, and
+    returns `num_notes` notes whose first three start times are the x, y and
+    z that were decoded, in milliseconds """
+
+    def __init__(self, mode: str, decode_ms: float, num_notes: int = 32,
+                 midi_output_dir: Optional[str] = None) -> None:
+        self.mode = mode
+        self.decode_ms = decode_ms
+        self.num_notes = max(num_notes, 3)
+        self.midi_output_dir = midi_output_dir or tempfile.mkdtemp(prefix="serving_bench_")
+        self.ready = True
+        self.prefetcher = None
+
+    def decode_phrase(self, z: np.ndarray, length: Optional[int] = 32,
+                      temperature: float = 1.0) -> Optional[Phrase]:
+        return self.decode_phrases(z.reshape(-1, z.shape[-1])[:1], temperature)[0]
+
+    def decode_phrases(self, z: np.ndarray,
+                       temperature: float = 1.0) -> List[Optional[Phrase]]:
+        z = z.reshape(-1, z.shape[-1])
+        with METRICS.span("sess_run", self.mode):
+            time.sleep(self.decode_ms / 1000)
+        return [Phrase(None, sequence=self._sequence(row), mode=self.mode) for row in z]
+
+    def _sequence(self, z: np.ndarray) -> music_pb2.NoteSequence:
+        seq = music_pb2.NoteSequence()
+        # the server scales the received coordinate by 6
+        starts = list(np.asarray(z, dtype=np.float64) / 6)
+        starts += [i * 0.125 for i in range(3, self.num_notes)]
+        for start in starts:
+            seq.notes.add(pitch=60, velocity=80, start_time=start, end_time=start + 0.125)
+        return seq
+
+    def midi_path(self, mode: str) -> str:
+        return os.path.join(self.midi_output_dir, f"{time.perf_counter_ns()}_{mode}.mid")
+
+    def write_midi(self, notes: music_pb2.NoteSequence, mode: str) -> str:
+        path = self.midi_path(mode)
+        write_midi_durable(notes, path)
+        return path
+
+
+def load_real_model(mode: str) -> Any:
+    from generator import CONFIG, MusicVAEModel
+
+    vae_key, model_key = MODEL_CONFIGS[mode]
+    vae = MusicVAEModel(CONFIG[f"model_path_vae_{mode}"], CONFIG[f"model_path_midime_{mode}"],
+                        vae_key, model_key, mode=mode)
+    vae.load_model()
+    return vae
+
+
+def synthetic_stream(modes: List[str], rate: float, duration: float,
+                     seed: int = 0) -> List[Event]:
+    """ every mode sends `rate` z per second along its own lissajous curve,
+    which moves like a hand in the unit cube """
+    rng = np.random.RandomState(seed)
+    events: List[Event] = []
+    n = int(rate * duration)
+    for m, mode in enumerate(modes):
+        freq = 0.2 + rng.uniform(0, 0.3, size=3)
+        phase = rng.uniform(0, 2 * math.pi, size=3)
+        offset = m / (len(modes) * rate)  # modes do not send at the same instant
+        for i in range(n):
+            t = offset + i / rate
+            xyz = np.sin(2 * math.pi * freq * t + phase) * 0.9
+            events.append((t, f"/z_{mode}", tuple(float(v) for v in xyz)))
+    events.sort(key=lambda e: e[0])
+    return events
+
+
+def load_stream(path: str, speed: float = 1.0) -> List[Event]:
+    events: List[Event] = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip() or line.startswith("#"):
+                continue
+            t, address, x, y, z = line.split()
+            events.append((float(t) / speed, address, (float(x), float(y), float(z))))
+    events.sort(key=lambda e: e[0])
+    return events
+
+
+def save_stream(events: List[Event], path: str) -> None:
+    with open(path, "w") as f:
+        for t, address, (x, y, z) in events:
+            f.write(f"{t:.6f} {address} {x:.{Z_DECIMALS}f} {y:.{Z_DECIMALS}f} {z:.{Z_DECIMALS}f}\n")
+
+
+def _key(xyz) -> Tuple[float, ...]:
+    return tuple(round(float(v), Z_DECIMALS) for v in xyz)
+
+
+class ReplyRecorder:
+    """ receives the replies of the server and matches them to sent z """
+
+    def __init__(self, payload_format: str, match_z: bool) -> None:
+        self.payload_format = payload_format
+        self.match_z = match_z
+        self.sent: Dict[str, int] = collections.Counter()
+        self.replies: Dict[str, int] = collections.Counter()
+        self.done: Dict[str, int] = collections.Counter()
+        self.unmatched: Dict[str, int] = collections.Counter()
+        self.latencies: Dict[str, List[float]] = collections.defaultdict(list)
+        self.first_sent: Optional[float] = None
+        self.last_reply: Dict[str, float] = {}
+        # z (or only its order for real models) -> send times
+        self._pending: Dict[Any, Deque[float]] = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+
+    def on_sent(self, mode: str, xyz: Tuple[float, float, float], t: float) -> None:
+        with self._lock:
+            if self.first_sent is None:
+                self.first_sent = t
+            self.sent[mode] += 1
+            self._pending[(mode, _key(xyz) if self.match_z else None)].append(t)
+
+    def _reply_z(self, values: Tuple[Any, ...]) -> Optional[Tuple[float, ...]]:
+        if self.payload_format == "string":
+            tokens = str(values[0]).split(" ")
+            starts = [float(tokens[i]) for i in (2, 6, 10)]
+        else:
+            starts = [float(values[i]) for i in (2, 6, 10)]
+        return _key(np.asarray(starts, dtype=np.float64) / 1000)
+
+    def on_reply(self, address: str, *values: Any) -> None:
+        t = time.perf_counter()
+        if address.startswith("/generate_done_"):
+            with self._lock:
+                self.done[address[len("/generate_done_"):]] += 1
+            return
+        if not address.startswith("/generated_notes_"):
+            return
+        mode = address[len("/generated_notes_"):]
+        key = (mode, self._reply_z(values) if self.match_z else None)
+        with self._lock:
+            self.replies[mode] += 1
+            self.last_reply[mode] = t
+            pending = self._pending.get(key)
+            if not pending:
+                self.unmatched[mode] += 1
+                return
+            self.latencies[mode].append(t - pending.popleft())
+
+    def report(self, duration: float) -> Dict[str, Dict[str, float]]:
+        result = {}
+        with self._lock:
+            for mode in sorted(self.sent):
+                latencies = np.array(self.latencies[mode]) * 1000
+                answered = len(latencies)
+                entry = {"sent": self.sent[mode],
+                         "replies": self.replies[mode],
+                         "done": self.done[mode],
+                         "unmatched": self.unmatched[mode],
+                         "drop_rate": round(1 - answered / self.sent[mode], 4),
+                         "throughput_per_sec": round(self.replies[mode] / duration, 2)}
+                if answered:
+                    for p in (50, 95, 99):
+                        entry[f"latency_p{p}_ms"] = round(float(np.percentile(latencies, p)), 3)
+                    entry["latency_max_ms"] = round(float(latencies.max()), 3)
+                result[mode] = entry
+        return result
+
+
+def replay(events: List[Event], ip: str, port: int, recorder: ReplyRecorder) -> float:
+    """ sends every event at its time; returns the time it took """
+    client = udp_client.SimpleUDPClient(ip, port)
+    start = time.perf_counter()
+    for t, address, xyz in events:
+        delay = start + t - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        msg = " ".join(f"{v:.{Z_DECIMALS}f}" for v in xyz)
+        recorder.on_sent(address[len("/z_"):], xyz, time.perf_counter())
+        client.send_message(address, msg)
+    return time.perf_counter() - start
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    modes = [m for m in args.modes.split(",") if m]
+    decode_ms = [float(ms) for ms in args.stub_decode_ms.split(",")]
+    decode_ms += [decode_ms[-1]] * (len(MODES) - len(decode_ms))
+
+    if args.replay:
+        events = load_stream(args.replay, args.speed)
+    else:
+        events = synthetic_stream(modes, args.rate, args.duration, args.seed)
+    if args.save_stream:
+        save_stream(events, args.save_stream)
+
+    recorder = ReplyRecorder(args.osc_payload, match_z=args.model == "stub")
+    dispatcher = Dispatcher()
+    dispatcher.set_default_handler(recorder.on_reply)
+    receiver = ThreadingOSCUDPServer((args.ip, args.reply_port), dispatcher)
+    threading.Thread(target=receiver.serve_forever, daemon=True).start()
+
+    METRICS.clear()
+    server = OSCServer(args.ip, args.port)
+    server.data_manager = ReceivedNotesManager(
+        verbose=False, coalesce=args.coalesce, per_mode_workers=args.per_mode_workers)
+    sender = OSCSender(args.ip, args.reply_port, payload_format=args.osc_payload)
+    midi_writer = None
+    if args.write_midi and args.midi_writer_threads > 0:
+        midi_writer = MidiWriter(args.midi_writer_threads)
+    for i, mode in enumerate(MODES):
+        if args.model == "stub":
+            model = StubModel(mode, decode_ms[i], args.stub_notes)
+        elif mode in modes:
+            model = load_real_model(mode)
+        else:
+            continue
+        setattr(server.data_manager, f"on_output_{mode}", on_output_note_sequence_func(
+            model, osc_sender=sender, midi_writer=midi_writer, write_midi=args.write_midi))
+
+    server.data_manager.start()
+    server.run()
+    time.sleep(0.2)  # let the server thread bind
+    # the handlers print every reply
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull if not args.verbose else sys.stdout):
+        elapsed = replay(events, args.ip, args.port, recorder)
+        time.sleep(args.drain)
+        server.shutdown()
+        server.data_manager.stop()
+        if midi_writer is not None:
+            midi_writer.close()
+    receiver.shutdown()
+
+    last_reply = max(recorder.last_reply.values(), default=time.perf_counter())
+    duration = max(last_reply - (recorder.first_sent or last_reply), elapsed, 1e-9)
+    result = {"config": {k: v for k, v in vars(args).items() if k != "json"},
+              "events": len(events),
+              "send_sec": round(elapsed, 3),
+              "modes": recorder.report(duration),
+              "stages_ms": METRICS.percentiles()}
+    if server.data_manager.mailbox is not None:
+        result["mailbox"] = server.data_manager.mailbox.stats()
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", choices=("stub", "real"), default="stub",
+                        help="stub: sleep instead of decoding (no TF session), real: the models of config.yml")
+    parser.add_argument("--modes", type=str, default="drums,mel,bass")
+    parser.add_argument("--rate", type=float, default=30.0,
+                        help="z per second and mode of the synthetic stream")
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="seconds of synthetic stream")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--replay", type=str, default=None,
+                        help="replay a recorded `seconds address x y z` stream instead")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed factor of --replay")
+    parser.add_argument("--save_stream", type=str, default=None,
+                        help="write the replayed stream to this file")
+    parser.add_argument("--stub_decode_ms", type=str, default="20,40,150",
+                        help="stub decode time of drums, mel and bass (comma separated)")
+    parser.add_argument("--stub_notes", type=int, default=32,
+                        help="notes per stub phrase")
+    parser.add_argument("--coalesce", action="store_true")
+    parser.add_argument("--per_mode_workers", action="store_true")
+    parser.add_argument("--osc_payload", choices=PAYLOAD_FORMATS, default="string")
+    parser.add_argument("--write_midi", action="store_true",
+                        help="write MIDI files too (into a temporary directory with the stub)")
+    parser.add_argument("--midi_writer_threads", type=int, default=1)
+    parser.add_argument("--ip", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=57120)
+    parser.add_argument("--reply_port", type=int, default=57121)
+    parser.add_argument("--drain", type=float, default=2.0,
+                        help="seconds to wait for replies after the last z; later ones count as dropped")
+    parser.add_argument("--json", type=str, default=None,
+                        help="also write the result to this file")
+    parser.add_argument("--verbose", action="store_true",
+                        help="keep the per reply output of the handlers")
+    args = parser.parse_args()
+
+    result = run(args)
+    print(f"{result['events']} z sent in {result['send_sec']:.1f}s")
+    for mode, r in result["modes"].items():
+        latency = (f"p50 {r['latency_p50_ms']:8.1f} ms  p95 {r['latency_p95_ms']:8.1f} ms  "
+                   f"p99 {r['latency_p99_ms']:8.1f} ms" if "latency_p50_ms" in r else "no replies")
+        print(f"{mode:>6}: {r['throughput_per_sec']:7.1f} replies/s  drop {r['drop_rate']:6.1%}  {latency}")
+    print(METRICS.summary())
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
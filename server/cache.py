@@ -0,0 +1,69 @@
+import collections
+import threading
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+import numpy as np
+
+
+class DecodeCache:
+    """ bounded LRU cache of decode results keyed by a quantized z.
+
+    z is snapped to a grid of `step` so that a resting hand, which keeps
+    sending almost the same coordinate, hits the entry decoded for the first
+    one. `step=0` only matches bit-identical z. decode length and temperature
+    are part of the key because they change the output.
+    """
+
+    def __init__(self, max_size: int = 128, step: float = 0.05) -> None:
+        self.max_size = max_size
+        self.step = step
+        self.hits = 0
+        self.misses = 0
+        self._entries: "collections.OrderedDict[Hashable, Any]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, z: np.ndarray, length: Optional[int],
+            temperature: float) -> Tuple[Hashable, ...]:
+        z = np.asarray(z, dtype=np.float32).reshape(-1)
+        if self.step > 0:
+            quantized: Hashable = tuple(np.round(z / self.step).astype(np.int64).tolist())
+        else:
+            quantized = z.tobytes()
+        return (quantized, length, round(float(temperature), 6))
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {"size": len(self._entries),
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / total if total else 0.0}
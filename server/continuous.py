@@ -0,0 +1,223 @@
+import collections
+import threading
+import time
+from logging import debug, info, warn
+from typing import Any, Deque, Dict, List, NamedTuple, Optional
+
+import numpy as np
+from note_seq import DEFAULT_QUARTERS_PER_MINUTE
+
+from metrics import METRICS
+from phrase import Phrase
+
+
+class ScheduledPhrase(NamedTuple):
+    """ a decoded phrase and when (`time.monotonic`) it starts playing """
+    due: float
+    phrase: Phrase
+
+
+class ContinuousGenerator:
+    """ keeps decoding the next phrases of one mode ahead of playback.
+
+    `update(z)` only moves the latent position. a producer thread keeps up
+    to `lookahead` phrases of the current position decoded, one per slot of
+    `phrase_sec`, and a scheduler thread sends each one `send_ahead_sec`
+    before its slot starts, so a decode never delays the music as long as
+    it takes less than `lookahead` slots. when the position moves, the
+    phrases beyond the next `keep_on_update` are decoded again for the new
+    position. a slot whose phrase is not ready in time is skipped and counted
+    as an underrun.
+
+    with a `session` the position is the session's latest z of `mode` and
+    the phrases go to the session's sender, so the performers sharing a model
+    each get their own stream; without one it is the model's `latest_z`.
+    """
+
+    def __init__(self, vae: Any, mode: str, sender: Any,
+                 qpm: float = DEFAULT_QUARTERS_PER_MINUTE,
+                 lookahead: int = 2,
+                 send_ahead_sec: float = 0.05,
+                 keep_on_update: int = 1,
+                 noise_bias: float = -4,
+                 temperature: float = 1.0,
+                 session: Any = None) -> None:
+        self.vae = vae
+        self.mode = mode
+        self.sender = sender
+        self.session = session
+        self.qpm = qpm
+        self.lookahead = max(lookahead, 1)
+        self.send_ahead_sec = send_ahead_sec
+        self.keep_on_update = keep_on_update
+        self.noise_bias = noise_bias
+        self.temperature = temperature
+
+        self.sent = 0
+        self.underruns = 0
+        self.stale = 0
+
+        self._buffer: Deque[ScheduledPhrase] = collections.deque()
+        # start of the slot the next decoded phrase goes into, None until the first z
+        self._next_due: Optional[float] = None
+        # bumped by `update`, decodes started for an older position are thrown away
+        self._generation = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._threads: List[threading.Thread] = []
+
+    @property
+    def phrase_sec(self) -> float:
+        return self.vae.phrase_seconds * DEFAULT_QUARTERS_PER_MINUTE / self.qpm
+
+    @property
+    def latest_z(self) -> Optional[np.ndarray]:
+        if self.session is not None:
+            return self.session.latest_z.get(self.mode)
+        return self.vae.latest_z
+
+    def start(self) -> None:
+        if self._threads:
+            return
+        self._threads = [
+            threading.Thread(target=self._produce, name=f"continuous-decode-{self.mode}", daemon=True),
+            threading.Thread(target=self._schedule, name=f"continuous-send-{self.mode}", daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def update(self, z: np.ndarray, mode: Optional[str] = None, session: Any = None) -> None:
+        """ moves the latent position; same signature as the `on_output_*` callbacks """
+        with self._cond:
+            if self.session is not None:
+                self.session.latest_z[self.mode] = z
+            else:
+                self.vae.latest_z = z
+            self._generation += 1
+            while len(self._buffer) > self.keep_on_update:
+                dropped = self._buffer.pop()
+                self._next_due = dropped.due
+                self.stale += 1
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {"sent": self.sent,
+                    "underruns": self.underruns,
+                    "stale": self.stale,
+                    "buffered": len(self._buffer)}
+
+    def _produce(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed or (
+                    self.latest_z is not None and len(self._buffer) < self.lookahead))
+                if self._closed:
+                    return
+                generation = self._generation
+
+            if not self.vae.ready:
+                time.sleep(0.1)
+                continue
+            try:
+                phrase = self.vae.next_continuous_phrase(self.noise_bias, self.temperature,
+                                                         z=self.latest_z)
+            except Exception as e:
+                warn(f"Failed to decode continuous {self.mode} phrase: {e}")
+                phrase = None
+            if phrase is None:
+                time.sleep(0.1)
+                continue
+
+            with self._cond:
+                if generation != self._generation:
+                    continue  # the position moved while decoding
+                now = time.monotonic()
+                if self._next_due is None:
+                    # first phrase: start as soon as it can be sent
+                    self._next_due = now + self.send_ahead_sec
+                while self._next_due - self.send_ahead_sec < now:
+                    # decoded too late for this slot
+                    self._next_due += self.phrase_sec
+                    self.underruns += 1
+                self._buffer.append(ScheduledPhrase(self._next_due, phrase.at_tempo(self.qpm)))
+                self._next_due += self.phrase_sec
+                self._cond.notify_all()
+
+    def _schedule(self) -> None:
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if self._buffer:
+                        delay = self._buffer[0].due - self.send_ahead_sec - time.monotonic()
+                        if delay <= 0:
+                            break
+                        self._cond.wait(delay)
+                    else:
+                        self._cond.wait()
+                if self._closed:
+                    return
+                scheduled = self._buffer.popleft()
+                self.sent += 1
+                self._cond.notify_all()
+
+            # a session may register another reply port while playing
+            sender = getattr(self.session, "sender", None) or self.sender
+            if sender is None:
+                continue
+            with METRICS.span("send", self.mode):
+                sender.send_notes(f"/generated_notes_{self.mode}", scheduled.phrase)
+                sender.send(f"/generate_done_{self.mode}", '1')
+            debug(f"continuous {self.mode}: sent phrase due in "
+                  f"{(scheduled.due - time.monotonic()) * 1000:.0f} ms, {self.stats()}")
+
+
+def start_continuous(vaes: Dict[str, Any], sender: Any, **kwargs) -> Dict[str, ContinuousGenerator]:
+    """ one started `ContinuousGenerator` per mode of `vaes` """
+    generators = {mode: ContinuousGenerator(vae, mode, sender, **kwargs)
+                  for mode, vae in vaes.items()}
+    for mode, generator in generators.items():
+        generator.start()
+        info(f"continuous {mode}: {generator.phrase_sec:.2f}s phrases, "
+             f"{generator.lookahead} ahead")
+    return generators
+
+
+class SessionContinuous:
+    """ `ContinuousGenerator`s of every session, started on its first z of a mode.
+
+    `update` replaces the `on_output_*` callbacks with `--sessions`: the
+    z of each session moves only that session's stream """
+
+    def __init__(self, vaes: Dict[str, Any], sender: Any, **kwargs) -> None:
+        self.vaes = vaes
+        self.sender = sender
+        self.kwargs = kwargs
+        self._generators: Dict[Any, ContinuousGenerator] = {}
+        self._lock = threading.Lock()
+
+    def update(self, z: np.ndarray, mode: str, session: Any = None) -> None:
+        key = (getattr(session, "client_id", None), mode)
+        with self._lock:
+            generator = self._generators.get(key)
+            if generator is None:
+                generator = ContinuousGenerator(self.vaes[mode], mode, self.sender,
+                                                session=session, **self.kwargs)
+                generator.start()
+                self._generators[key] = generator
+                info(f"continuous {mode} of {session}: {generator.phrase_sec:.2f}s phrases, "
+                     f"{generator.lookahead} ahead")
+        generator.update(z, mode, session)
+
+    def stop(self) -> None:
+        with self._lock:
+            generators, self._generators = list(self._generators.values()), {}
+        for generator in generators:
+            generator.stop()
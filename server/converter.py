@@ -1,18 +1,15 @@
-import os
+import collections
 import threading
+import time
 from datetime import datetime, timedelta
-from logging import warn
-from typing import Any, Callable, List, Optional, Tuple
+from logging import debug, warn
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import numpy as np
-import yaml
 from note_seq import sequence_proto_to_midi_file
 from note_seq.protobuf.music_pb2 import NoteSequence
 
-from generator import create_note_seq
-
-with open(os.path.join(os.path.dirname(__file__), "..", "config.yml"), 'r') as yml:
-    CONFIG = yaml.safe_load(yml)
+from metrics import METRICS, LatencyStats
 
 
 def float2timedelta(d: float):
@@ -27,6 +24,110 @@ def default_func_on_midi_output(path: str) -> None:
     print("midi_path", path)
 
 
+class LatestZMailbox:
+    """ latest-wins mailbox that keeps only the newest z per mode and session.
+
+    A z that arrives while an older one for the same mode (and session) is
+    still waiting replaces it, and the older one is counted as dropped, so a
+    worker always decodes the freshest hand position instead of working
+    through a backlog. z of different sessions for the same mode are handed
+    out together so that they can be decoded as one batch.
+    """
+
+    def __init__(self, latency: LatencyStats = METRICS) -> None:
+        self._cond = threading.Condition()
+        self._latest: Dict[Tuple[Optional[str], str], Tuple[np.ndarray, Any]] = {}
+        # when the waiting z was put, for the `queue_wait` span
+        self._put_at: Dict[Tuple[Optional[str], str], float] = {}
+        self.latency = latency
+        self._pending: collections.deque = collections.deque()
+        self._closed = False
+        self.received: Dict[str, int] = collections.Counter()
+        self.dropped: Dict[str, int] = collections.Counter()
+        self.decoded: Dict[str, int] = collections.Counter()
+
+    def put(self, mode: str, z: np.ndarray, session: Any = None) -> None:
+        key = (getattr(session, "client_id", None), mode)
+        with self._cond:
+            self.received[mode] += 1
+            if key in self._latest:
+                self.dropped[mode] += 1
+            else:
+                self._pending.append(key)
+            self._latest[key] = (z, session)
+            self._put_at[key] = time.perf_counter()
+            self._cond.notify_all()
+
+    def get(self, modes: Optional[List[str]] = None,
+            timeout: Optional[float] = None) -> Optional[Tuple[str, List[Tuple[np.ndarray, Any]]]]:
+        """ blocks until a z for one of `modes` (any mode if None) is waiting
+        and returns `(mode, [(z, session), ...])` with the z of every session
+        waiting for that mode, or None when closed or timed out """
+        def ready() -> Optional[str]:
+            for _, mode in self._pending:
+                if modes is None or mode in modes:
+                    return mode
+            return None
+
+        with self._cond:
+            if not self._cond.wait_for(
+                    lambda: self._closed or ready() is not None, timeout):
+                return None
+            if self._closed:
+                return None
+            mode = ready()
+            keys = [key for key in self._pending if key[1] == mode]
+            now = time.perf_counter()
+            for key in keys:
+                self._pending.remove(key)
+                self.latency.record("queue_wait", mode, now - self._put_at.pop(key))
+            return mode, [self._latest.pop(key) for key in keys]
+
+    def task_done(self, mode: str, n: int = 1) -> None:
+        with self._cond:
+            self.decoded[mode] += n
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self._cond:
+            return {mode: {"received": self.received[mode],
+                           "dropped": self.dropped[mode],
+                           "decoded": self.decoded[mode]}
+                    for mode in self.received}
+
+
+class MailboxWorker(threading.Thread):
+    """ thread that takes the freshest z out of a `LatestZMailbox` and hands
+    it to `handler(mode, [(z, session), ...])` """
+
+    def __init__(self, mailbox: LatestZMailbox,
+                 handler: Callable[[str, List[Tuple[np.ndarray, Any]]], None],
+                 modes: Optional[List[str]] = None,
+                 name: Optional[str] = None) -> None:
+        super().__init__(name=name, daemon=True)
+        self.mailbox = mailbox
+        self.handler = handler
+        self.modes = modes
+
+    def run(self) -> None:
+        while True:
+            item = self.mailbox.get(self.modes)
+            if item is None:
+                return
+            mode, items = item
+            try:
+                self.handler(mode, items)
+            except Exception as e:
+                warn(f"Failed to handle z for {mode}: {e}")
+            finally:
+                self.mailbox.task_done(mode, len(items))
+            debug(f"{mode} mailbox: {self.mailbox.stats()[mode]}")
+
+
 class ReceivedNotesManager:
     """ this is a class for handling and buffering received notes for 
     transforming them to MIDI and sending them to generative models via callback
@@ -35,28 +136,46 @@ class ReceivedNotesManager:
     received data: `x y z velocity_x velocity_y velocity_z object_id`
     """
 
-    def __init__(self, verbose=True):
+    modes = ['drums', 'mel', 'bass']
+
+    def __init__(self, verbose=True, coalesce=False, per_mode_workers=False):
         self.n_threshold_notes = 3
         self.window_sec = 2.0
         self.on_output_drums: Callable[[np.ndarray], None] = default_func_on_output
         self.on_output_mel: Callable[[np.ndarray], None] = default_func_on_output
         self.on_output_bass: Callable[[np.ndarray], None] = default_func_on_output
+        # optional `(items, mode)` callbacks decoding the z of several
+        # sessions at once, `items` being `[(z, session), ...]`
+        self.on_output_batch: Dict[str, Callable[[List[Tuple[np.ndarray, Any]], str], None]] = {}
         # self.on_output_midi: Callable[[str], Any] = default_func_on_midi_output
         self.z = None
         self.verbose = verbose
 
+        # latest-wins dispatch: `receive` only stores z and a worker decodes
+        # it. with `per_mode_workers` every mode gets its own worker so that
+        # a slow bass decode never blocks a drums reply
+        self.per_mode_workers = per_mode_workers
+        self.mailbox: Optional[LatestZMailbox] = \
+            LatestZMailbox() if coalesce or per_mode_workers else None
+        self.workers: List[MailboxWorker] = []
+
     def update_start_point(self, d: datetime) -> None:
         raise NotImplementedError
 
-    def receive(self, z: np.ndarray, mode: str) -> None:
+    def receive(self, z: np.ndarray, mode: str, session: Any = None) -> None:
         # z: 3dim float32 ndarray
+        # session: `session.Session` of the sender, None without sessions
 
         self.z = z
 
         if self.verbose:
             print("-" * 20, "\n")
-        
-        self.output(mode)
+
+        if self.mailbox is not None:
+            for m in (self.modes if mode == 'all' else [mode]):
+                self.mailbox.put(m, z, session)
+        else:
+            self.output(mode, z, session)
 
         if self.verbose:
             print(
@@ -72,18 +191,58 @@ class ReceivedNotesManager:
         print("Stored notes cleared!")
         return
 
-    def output(self, mode: str):
+    def start(self) -> None:
+        """ starts the worker that drains the mailbox (coalesce mode only) """
+        if self.mailbox is None or self.workers:
+            return
+        if self.per_mode_workers:
+            groups = [[mode] for mode in self.modes]
+        else:
+            groups = [None]
+        for modes in groups:
+            name = f"decode-worker-{modes[0]}" if modes else "decode-worker"
+            worker = MailboxWorker(self.mailbox, self.output_batch,
+                                   modes=modes, name=name)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self) -> None:
+        if self.mailbox is not None:
+            self.mailbox.close()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def output(self, mode: str, z: Optional[np.ndarray] = None, session: Any = None):
+        z = self.z if z is None else z
+        # the session is only passed on when there is one, so callbacks
+        # taking `(z, mode)` keep working
+        extra = (session,) if session is not None else ()
+
         if mode == 'drums':
-            self.on_output_drums(self.z, mode)
+            self.on_output_drums(z, mode, *extra)
 
         if mode == 'mel':
-            self.on_output_mel(self.z, mode)
+            self.on_output_mel(z, mode, *extra)
 
         if mode == 'bass':
-            self.on_output_bass(self.z, mode)
+            self.on_output_bass(z, mode, *extra)
 
         if mode == 'all':
-            # self.on_output_drums(self.z, mode)
-            # self.on_output_mel(self.z, mode)
-            # self.on_output_bass(self.z, mode)
-            raise NotImplementedError
+            # each model has its own session, so the three decodes can run
+            # side by side (TF releases the GIL inside `sess.run`)
+            threads = [threading.Thread(target=self.output, args=(m, z, session))
+                       for m in self.modes]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+    def output_batch(self, mode: str, items: List[Tuple[np.ndarray, Any]]) -> None:
+        """ outputs the z of several sessions, in one decode if the mode has
+        an `on_output_batch` callback """
+        if len(items) > 1 and mode in self.on_output_batch:
+            self.on_output_batch[mode](items, mode)
+            return
+        for z, session in items:
+            self.output(mode, z, session)
@@ -1,20 +1,23 @@
 import os
+import re
 import sys
 from datetime import datetime
-from logging import warn, debug, info
-from typing import Any, Optional
+from logging import warn
+from typing import TYPE_CHECKING, List, Optional, Tuple
 
 import numpy as np
-import yaml
-from note_seq.protobuf.music_pb2 import NoteSequence
 
-from generator import (MusicVAEModel,
-                       note_sequence_to_tokens_for_M4L, start_notes_at_0)
+from metrics import METRICS
+from midi_writer import MidiWriter
 from osc import OSCSender
+from phrase import Phrase
+from session import Session
+
+if TYPE_CHECKING:
+    # only for the annotations, so that the handlers load without TF
+    from generator import MusicVAEModel
 
 sys.path.append(os.path.dirname(__file__))
-with open(os.path.join(os.path.dirname(__file__), "..", "config.yml"), 'r') as yml:
-    CONFIG = yaml.safe_load(yml)
 
 
 def sample_note_recorder(n: int, t: datetime, v: int, d: float):
@@ -37,36 +40,121 @@ def on_output_midi_file_func(osc_sender: Optional[OSCSender] = None):
     return closure
 
 
-def on_output_note_sequence_func(vae: MusicVAEModel,
-                                 osc_sender: Optional[OSCSender] = None):
+def on_output_note_sequence_func(vae: "MusicVAEModel",
+                                 osc_sender: Optional[OSCSender] = None,
+                                 midi_writer: Optional[MidiWriter] = None,
+                                 write_midi: bool = True):
     """ it returns the function object that called when the NoteSequence
     object that packages sound inputs from the MR interface
+
+    with a `midi_writer` the MIDI file is written in the background and its
+    path is sent once the file is on disk; `write_midi=False` skips MIDI files
+    when only the OSC notes are used. with a `session` the replies go to the
+    session's sender instead of `osc_sender`
     """
-    def closure(z: np.ndarray, mode: str):
+    publish = _publish_func(vae, osc_sender, midi_writer, write_midi)
+
+    def closure(z: np.ndarray, mode: str, session: Optional[Session] = None):
         # z: 3dim float32 ndarray
+        if not _check_ready(vae, mode, session, osc_sender):
+            return
+        _observe(vae, z, session)
+        publish(vae.decode_phrase(z), z, mode, session)
+    return closure
+
+
+def on_output_note_sequences_func(vae: "MusicVAEModel",
+                                  osc_sender: Optional[OSCSender] = None,
+                                  midi_writer: Optional[MidiWriter] = None,
+                                  write_midi: bool = True):
+    """ same as `on_output_note_sequence_func` for the z of several sessions
+    waiting at once (`ReceivedNotesManager.on_output_batch`); they share the
+    model, so their z are decoded together """
+    publish = _publish_func(vae, osc_sender, midi_writer, write_midi)
+
+    def closure(items: List[Tuple[np.ndarray, Optional[Session]]], mode: str):
+        items = [(z, session) for z, session in items
+                 if _check_ready(vae, mode, session, osc_sender)]
+        if not items:
+            return
+        for z, session in items:
+            _observe(vae, z, session)
+        phrases = vae.decode_phrases(np.concatenate(
+            [z.reshape(-1, z.shape[-1])[:1] for z, _ in items]))
+        for (z, session), phrase in zip(items, phrases):
+            publish(phrase, z, mode, session)
+    return closure
 
-        generated = vae.decode(z)
 
-        if generated is not None:
+def _check_ready(vae: "MusicVAEModel", mode: str, session: Optional[Session],
+                 osc_sender: Optional[OSCSender]) -> bool:
+    if vae.ready:
+        return True
+    # still loading (see `--parallel_load`)
+    sender = session.sender if session is not None and session.sender else osc_sender
+    if sender:
+        sender.send(f"/model_not_ready_{mode}", '1')
+    else:
+        print(f"model_not_ready_{mode}")  # for python-shell on Node for Max
+    return False
 
-            ######################################################
-            generated = start_notes_at_0(generated)
 
-            output = note_sequence_to_tokens_for_M4L(generated)
-            if osc_sender:
-                print(f"{mode} notes are sent to {osc_sender.client._port}")
-                osc_sender.send(f"/generated_notes_{mode}", output)
-                osc_sender.send(f"/generate_done_{mode}", '1')
-            ######################################################
+def _observe(vae: "MusicVAEModel", z: np.ndarray, session: Optional[Session]) -> None:
+    """ feeds the trajectory of every client to the prefetcher """
+    if vae.prefetcher is not None:
+        vae.prefetcher.observe(z.reshape(-1, z.shape[-1])[0],
+                               track=session.client_id if session is not None else None)
 
-            midi_path = vae.write_midi(generated, mode)
 
-            if osc_sender:
-                print(f"midi_path_vae_{mode}", midi_path, "sent to osc")
-                osc_sender.send(f"/midi_path_vae_{mode}", midi_path)
-            else:
-                # for python-shell on Node for Max
-                print(f"midi_path_vae_{mode}", midi_path)
+def _publish_func(vae: "MusicVAEModel",
+                  osc_sender: Optional[OSCSender],
+                  midi_writer: Optional[MidiWriter],
+                  write_midi: bool):
+    """ sends a decoded phrase and its MIDI file to the session (or `osc_sender`) """
+    def send_midi_path(sender: Optional[OSCSender], midi_path: str, mode: str):
+        if sender:
+            print(f"midi_path_vae_{mode}", midi_path, "sent to osc")
+            sender.send(f"/midi_path_vae_{mode}", midi_path)
         else:
+            # for python-shell on Node for Max
+            print(f"midi_path_vae_{mode}", midi_path)
+
+    def publish(phrase: Optional[Phrase], z: np.ndarray, mode: str,
+                session: Optional[Session]):
+        if phrase is None:
             warn("Failed to generate NoteSequence")
-    return closure
+            return
+
+        sender = osc_sender
+        file_mode = mode
+        if session is not None:
+            session.latest_z[mode] = z
+            sender = session.sender or osc_sender
+            file_mode = f"{mode}_{re.sub(r'[^0-9A-Za-z]+', '-', session.client_id)}"
+
+        ######################################################
+        if sender:
+            print(f"{mode} notes are sent to {sender.client._port}")
+            # serialize outside of the `send` span, it has its own
+            payload = sender.serialize(f"/generated_notes_{mode}", phrase)
+            with METRICS.span("send", mode):
+                sender.send_payload(payload)
+                sender.send(f"/generate_done_{mode}", '1')
+        ######################################################
+
+        if not write_midi:
+            return
+        if midi_writer is not None:
+            def on_written(midi_path: str) -> None:
+                if midi_path:  # "" if dropped or failed
+                    send_midi_path(sender, midi_path, mode)
+
+            # the NoteSequence is built on the writer thread, for the MIDI file only
+            midi_writer.submit(lambda: phrase.sequence, vae.midi_path(file_mode), on_written,
+                               mode=mode)
+        else:
+            sequence = phrase.sequence
+            with METRICS.span("midi_write", mode):
+                midi_path = vae.write_midi(sequence, file_mode)
+            send_midi_path(sender, midi_path, mode)
+    return publish
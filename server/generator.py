@@ -1,11 +1,13 @@
-import collections
 from functools import wraps
 import os
+import threading
+import time
 import warnings
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from logging import warn, debug, info
-from typing import Any, List, Optional
+from typing import Any, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 import yaml
@@ -24,8 +26,16 @@ with open(os.path.join(os.path.dirname(__file__),
 
 import sys
 sys.path.append('../')
+from batching import MicroBatchDecoder
+from cache import DecodeCache
+from interpolation import interpolate_path
 import midime_configs as configs
-from midime_trained_model import TrainedModel
+from midime_latent_grid import LatentGrid
+from metrics import METRICS
+from midime_trained_model import FrozenTrainedModel, TrainedModel
+from phrase import Phrase, phrase_seconds, start_notes_at_0
+from prefetch import TrajectoryPrefetcher
+from tokens import note_matrix_to_tokens, note_sequence_to_matrix
 
 
 def create_note_seq(notes: List[int],
@@ -54,29 +64,9 @@ def create_note_seq(notes: List[int],
     return sequence
 
 
-def start_notes_at_0(s: NoteSequence) -> NoteSequence:
-    """ If a sequence has notes at time before 0.0, scootch them up to 0 """
-    for n in s.notes:
-        if n.start_time < 0:
-            n.end_time -= n.start_time
-            n.start_time = 0
-    return s
-
-
 def note_sequence_to_tokens_for_M4L(seq: NoteSequence) -> str:
-    output_data = ""
-    maped_output = None
-    output_midi = collections.defaultdict(list)
-    for seq_note in seq.notes:
-        # TODO: remove drums/bass output
-        start_time = seq_note.start_time * 1000
-        end_time = seq_note.end_time * 1000
-        output_midi['notes'].append([seq_note.pitch, seq_note.velocity, '{:.2f}'.format(
-            start_time), '{:.2f}'.format(end_time)])
-        maped_output = map(
-            str, sum(output_midi['notes'], []))
-        output_data = ' '.join(maped_output)
-    return output_data
+    """ `pitch velocity start_ms end_ms` of every note, space separated """
+    return note_matrix_to_tokens(note_sequence_to_matrix(seq))
 
 
 class ModelInterface(metaclass=ABCMeta):
@@ -107,15 +97,70 @@ class MusicVAEModel(ModelInterface):
     def __init__(self, vae_ckpt_path: str, model_ckpt_path: str,
                  vae_config_map_key: Optional[str] = "cat-drums_2bar_small",
                  model_config_map_key: Optional[str] = "cat-drums_2bar_small_3dim",
-                 midi_output_dir: str = CONFIG["midi_output_dir"]) -> None:
+                 midi_output_dir: str = CONFIG["midi_output_dir"],
+                 intra_op_threads: int = 0,
+                 inter_op_threads: int = 0,
+                 decode_cache_size: int = 0,
+                 decode_cache_step: float = 0.05,
+                 batch_window_sec: float = 0.0,
+                 speculative_radius: float = 0.0,
+                 batch_size: int = 4,
+                 batch_buckets: Optional[List[int]] = None,
+                 decode_from_z: bool = True,
+                 build_encoder: bool = True,
+                 checkpoint_cache_dir: Optional[str] = None,
+                 frozen_graph_path: Optional[str] = None,
+                 warmup: bool = True,
+                 warmup_lengths: Optional[List[int]] = None,
+                 mode: Optional[str] = None) -> None:
         self.latest_z: Optional[np.ndarray] = None
+        # tag of the latency spans, e.g. `drums`
+        self.mode = mode or model_config_map_key
         self.model: Optional[TrainedModel] = None
+        # set once `load_model` succeeded; requests before that are refused
+        self.ready = False
+        self.load_time: Optional[float] = None
+        self.warmup_time: Optional[float] = None
         self.vae_ckpt_path = vae_ckpt_path
         self.model_ckpt_path = model_ckpt_path
         self.midi_output_dir = midi_output_dir
         self.vae_config_map_key = vae_config_map_key
         self.model_config_map_key = model_config_map_key
         self.max_seq_len = configs.CONFIG_MAP[model_config_map_key].hparams.max_seq_len
+        # precomputed decodes answered by lookup instead of `sess.run`
+        self.latent_grid: Optional[LatentGrid] = None
+        self.latent_grid_blend = False
+        # recently decoded `Phrase`s keyed by quantized z
+        self.decode_cache: Optional[DecodeCache] = \
+            DecodeCache(decode_cache_size, decode_cache_step) if decode_cache_size > 0 else None
+        # packs concurrent decodes into one `sess.run` when window > 0
+        self.batcher: Optional[MicroBatchDecoder] = None
+        self.batch_window_sec = batch_window_sec
+        self.speculative_radius = speculative_radius
+        # decodes predicted z into the decode cache (`enable_prefetch`)
+        self.prefetcher: Optional[TrajectoryPrefetcher] = None
+        # live decodes running now; prefetching waits for 0
+        self.in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        # a lone live decode runs on the smallest bucket instead of batch_size
+        self.batch_size = batch_size
+        self.batch_buckets = batch_buckets
+        # also build decode ops fed with full z (encoded phrases, interpolations)
+        self.decode_from_z = decode_from_z
+        # encoder for generate_from_sequence / interpolation
+        self.build_encoder = build_encoder
+        # where bundled checkpoints are unbundled once and reused from
+        self.checkpoint_cache_dir = checkpoint_cache_dir
+        # graph exported by `midime_export.py --mode frozen_graph`, loaded instead
+        # of building the model and restoring both checkpoints
+        self.frozen_graph_path = frozen_graph_path
+        # dummy decodes run before `ready` so the first live one is not the slow one;
+        # lengths default to the one `_decode` uses
+        self.warmup_enabled = warmup
+        self.warmup_lengths = warmup_lengths
+        # session thread pools, 0 lets TensorFlow decide
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
 
         # TODO: 長さ決めておく
         self.previous_sequence: Optional[NoteSequence] = None
@@ -130,20 +175,105 @@ class MusicVAEModel(ModelInterface):
         # aster/magenta/models/music_vae#pre-trained-checkpoints
         # !gsutil - q - m cp - R gs: // download.magenta.tensorflow.org/models/m
         # sic_vae/colab2/checkpoints/mel_2bar_big.ckpt.* / content/
-        info("Initializing Music VAE...")
+        info(f"Initializing Music VAE... ({self.vae_config_map_key})")
+        start = time.perf_counter()
         try:
-            self.model = TrainedModel(
-                vae_config=vae_configs.CONFIG_MAP[self.vae_config_map_key],
-                model_config=configs.CONFIG_MAP[self.model_config_map_key],
-                batch_size=4,
-                vae_checkpoint_dir_or_path=vae_path if vae_path else self.vae_ckpt_path,
-                model_checkpoint_dir_or_path=model_path if model_path else self.model_ckpt_path,
-                model_var_pattern=['latent'])
-            info(f"Loding Model Done!: {self.vae_ckpt_path}")
+            if self.frozen_graph_path:
+                self.model = FrozenTrainedModel(
+                    vae_config=vae_configs.CONFIG_MAP[self.vae_config_map_key],
+                    model_config=configs.CONFIG_MAP[self.model_config_map_key],
+                    frozen_graph_path=self.frozen_graph_path,
+                    intra_op_threads=self.intra_op_threads,
+                    inter_op_threads=self.inter_op_threads)
+            else:
+                self.model = TrainedModel(
+                    vae_config=vae_configs.CONFIG_MAP[self.vae_config_map_key],
+                    model_config=configs.CONFIG_MAP[self.model_config_map_key],
+                    batch_size=self.batch_size,
+                    vae_checkpoint_dir_or_path=vae_path if vae_path else self.vae_ckpt_path,
+                    model_checkpoint_dir_or_path=model_path if model_path else self.model_ckpt_path,
+                    model_var_pattern=['latent'],
+                    intra_op_threads=self.intra_op_threads,
+                    inter_op_threads=self.inter_op_threads,
+                    batch_buckets=self.batch_buckets,
+                    decode_from_z=self.decode_from_z,
+                    build_encoder=self.build_encoder,
+                    checkpoint_cache_dir=self.checkpoint_cache_dir)
+            info(f"Loding Model Done!: {self.frozen_graph_path or self.vae_ckpt_path}")
+            if self.batch_window_sec > 0:
+                self.batcher = MicroBatchDecoder(
+                    self.model, self.batch_window_sec,
+                    speculative_radius=self.speculative_radius,
+                    on_speculative=self._store_speculative,
+                    spare_rows=self._spare_rows)
+            self.load_time = time.perf_counter() - start
+            info(f"{self.vae_config_map_key} loaded in {self.load_time:.1f}s")
+            if self.warmup_enabled:
+                self.warmup(self.warmup_lengths)
+            self.ready = True
+            info(f"{self.vae_config_map_key} ready")
         except Exception as e:
             warn(f"Failed to load model: {self.vae_ckpt_path}")
             warn(e)
 
+    def warmup(self, lengths: Optional[List[int]] = None) -> float:
+        """ runs a dummy decode through every batch bucket and length, on both
+        the z' and the full z ops, so that graph optimization, allocations and
+        kernel selection happen now instead of on the first live request """
+        lengths = lengths or [self.max_seq_len]
+        start = time.perf_counter()
+        runs = 0
+        try:
+            for bucket in self.model.batch_buckets:
+                for length in lengths:
+                    self.model.decode_to_tensors(
+                        np.zeros((bucket, self.model.encoded_z_size), np.float32), length)
+                    runs += 1
+                    if self.model.can_decode_z:
+                        self.model.decode_z_to_tensors(
+                            np.zeros((bucket, self.model.z_size), np.float32), length)
+                        runs += 1
+        except Exception as e:
+            warn(f"Failed to warm up {self.vae_config_map_key}: {e}")
+        self.warmup_time = time.perf_counter() - start
+        info(f"{self.vae_config_map_key} warmed up in {self.warmup_time:.1f}s ({runs} decodes)")
+        return self.warmup_time
+
+    def load_latent_grid(self, path: str, blend: bool = False,
+                         temperature: float = 1.0) -> None:
+        """ loads a grid made by `midime_precompute_grid.py`; `decode` then
+        answers 3dim z from the nearest voxel (or a blend of the neighbours).
+        `temperature` is the one of live decodes, a grid made at another one
+        is loaded with a warning """
+        try:
+            grid = LatentGrid.load(path)
+        except Exception as e:
+            warn(f"Failed to load latent grid: {path}")
+            warn(e)
+            return
+        config_key = grid.metadata.get("config")
+        if config_key and config_key != self.model_config_map_key:
+            warn(f"latent grid {path} was made for {config_key}, "
+                 f"not {self.model_config_map_key}")
+            return
+        grid_length = grid.metadata.get("length")
+        if grid_length is not None and int(grid_length) != self.max_seq_len:
+            warn(f"latent grid {path} holds {grid_length} steps, "
+                 f"not the {self.max_seq_len} of {self.model_config_map_key}")
+            return
+        grid_temperature = grid.metadata.get("temperature")
+        if grid_temperature is not None and float(grid_temperature) != temperature:
+            warn(f"latent grid {path} was decoded at temperature {grid_temperature}, "
+                 f"live decodes use {temperature}")
+        self.latent_grid = grid
+        self.latent_grid_blend = blend
+        info(f"Loading latent grid Done!: {path} "
+             f"({'x'.join(map(str, grid.grid_shape))})")
+
+    @property
+    def data_converter(self):
+        return configs.CONFIG_MAP[self.model_config_map_key].data_converter
+
     def get_configs(self):
         print(configs)
         return configs
@@ -168,26 +298,173 @@ class MusicVAEModel(ModelInterface):
             warn("MelodyRNN model not loaded!, call `MusicVAEModel.load_model()`")
 
     def decode(self, z: np.ndarray,
-               length: Optional[int] = 32) -> Optional[NoteSequence]:
+               length: Optional[int] = 32,
+               temperature: float = 1.0) -> Optional[NoteSequence]:
         """
         zからNoteSequenceをdecodeする関数
 
         ref: https://colab.research.google.com/notebooks/magenta/hello_magenta/
         hello_magenta.ipynb#scrollTo=QhtRBNNf05CA
         """
-        if self.model:
-            length = self.max_seq_len
-            decoded = self.model.decode(z, length=length)
+        if self.decode_cache is not None:
+            return self.decode_with_tokens(z, length, temperature)[0]
+        return self._decode(z, temperature)
+
+    def decode_with_tokens(self, z: np.ndarray,
+                           length: Optional[int] = 32,
+                           temperature: float = 1.0) -> Tuple[Optional[NoteSequence], str]:
+        """ decodes z and also returns the M4L token string of the result,
+        both taken from the decode cache when a nearby z was decoded recently """
+        phrase = self.decode_phrase(z, length, temperature)
+        if phrase is None:
+            return None, ""
+        return phrase.sequence, phrase.tokens
+
+    def decode_phrase(self, z: np.ndarray,
+                      length: Optional[int] = 32,
+                      temperature: float = 1.0) -> Optional[Phrase]:
+        """ decodes the first z into a `Phrase`, whose tokens come straight from
+        the output tensor; its NoteSequence is only built if asked for """
+        return self.decode_phrases(z.reshape(-1, z.shape[-1])[:1], temperature)[0]
+
+    def decode_phrases(self, z: np.ndarray,
+                       temperature: float = 1.0,
+                       cached: bool = True) -> List[Optional[Phrase]]:
+        """ decodes every row of z (e.g. the z of several sessions); rows not
+        in the decode cache are decoded together. with `cached=False` every
+        row is sampled by the model, skipping the decode cache and the latent grid """
+        z = z.reshape(-1, z.shape[-1])
+        phrases: List[Optional[Phrase]] = [None] * len(z)
+        keys: List[Any] = [None] * len(z)
+        missing = []
+        for i, row in enumerate(z):
+            if cached and self.decode_cache is not None:
+                keys[i] = self.decode_cache.key(row, self.max_seq_len, temperature)
+                hit = self.decode_cache.get(keys[i])
+                if self.prefetcher is not None:
+                    self.prefetcher.record_lookup(keys[i], hit is not None)
+                if hit is not None:
+                    debug(f"decode cache hit: {self.decode_cache.stats()}")
+                    phrases[i] = hit
+                    continue
+            missing.append(i)
+        if not missing:
+            return phrases
+
+        with self._in_flight_lock:
+            self.in_flight += 1
+        try:
+            tensors = self._decode_tensors(z[missing], temperature, use_grid=cached)
+        finally:
+            with self._in_flight_lock:
+                self.in_flight -= 1
+        if tensors is None:
+            return phrases
+        for i, tensor in zip(missing, tensors):
+            phrases[i] = Phrase(self.data_converter, tensor, mode=self.mode)
+            if keys[i] is not None:
+                self.decode_cache.put(keys[i], phrases[i])
+        return phrases
+
+    def _decode_tensors(self, z: np.ndarray, temperature: float = 1.0,
+                        stage: str = "sess_run",
+                        use_grid: bool = True) -> Optional[List[np.ndarray]]:
+        """ output tensors of every row of z, from the latent grid, the batcher or the model;
+        the decode is recorded as the `stage` latency span """
+        length = self.max_seq_len
+        if use_grid and self.latent_grid is not None and length == self.latent_grid.length \
+                and z.shape[-1] == self.latent_grid.axes.shape[0]:
+            return [self.latent_grid.lookup(row, blend=self.latent_grid_blend) for row in z]
+        elif not self.model:
+            warn("MelodyRNN model not loaded!, call `MusicVAEModel.load_model()`")
+            return None
+        # with the batcher this includes the wait for the batch window
+        with METRICS.span(stage, self.mode):
+            if self.batcher is not None:
+                return self.batcher.decode_to_tensors(z, length, temperature)
+            elif z.shape[-1] == self.model.z_size:
+                return self.model.decode_z_to_tensors(z, length=length, temperature=temperature)
+            return self.model.decode_to_tensors(z, length=length, temperature=temperature)
+
+    def _decode(self, z: np.ndarray,
+                temperature: float = 1.0) -> Optional[NoteSequence]:
+        length = self.max_seq_len
+        if self.latent_grid is not None and length == self.latent_grid.length \
+                and z.shape[-1] == self.latent_grid.axes.shape[0]:
+            tensor = self.latent_grid.lookup(z, blend=self.latent_grid_blend)
+            decoded = self.data_converter.from_tensors([tensor])
+        elif self.model and self.batcher is not None:
+            tensors = self.batcher.decode_to_tensors(z, length, temperature)
+            decoded = self.data_converter.from_tensors(tensors)
+        elif self.model and z.shape[-1] == self.model.z_size:
+            # full MusicVAE z, e.g. an encoded phrase: skip the MidiMe MLP
+            decoded = self.model.decode_z(z, length=length, temperature=temperature)
+            info(f"decoded {len(decoded)} NoteSequence objects from full z")
+        elif self.model:
+            decoded = self.model.decode(z, length=length, temperature=temperature)
             info(f"decoded {len(decoded)} NoteSequence objects")
-            self.previous_sequences = decoded
-            return decoded[0]
         else:
             warn("MelodyRNN model not loaded!, call `MusicVAEModel.load_model()`")
+            return None
+        # normalised like `Phrase.sequence`, so that `decode` returns the same
+        # with and without the decode cache
+        self.previous_sequences = [start_notes_at_0(s) for s in decoded]
+        return self.previous_sequences[0]
+
+    def _store_speculative(self, z: np.ndarray, tensor: np.ndarray,
+                           length: Optional[int], temperature: float) -> None:
+        """ puts a decode of a spare batch row into the decode cache """
+        if self.decode_cache is None:
+            return
+        key = self.decode_cache.key(z, length, temperature)
+        if key in self.decode_cache:
+            return
+        self.decode_cache.put(key, Phrase(self.data_converter, tensor, mode=self.mode))
+        if self.prefetcher is not None:
+            self.prefetcher.mark_prefetched(key)
+
+    def _spare_rows(self, z: np.ndarray, n: int) -> np.ndarray:
+        """ predicted z for the spare rows of a live batch """
+        if self.prefetcher is None:
+            return np.empty((0, z.shape[-1]), np.float32)
+        return self.prefetcher.spare_rows(z, n)
+
+    def enable_prefetch(self, method: str = "constant_velocity", history: int = 4,
+                        num_points: int = 2) -> Optional[TrajectoryPrefetcher]:
+        """ starts decoding the predicted next z of every performer into the
+        decode cache; needs `decode_cache_size > 0` """
+        if self.decode_cache is None:
+            warn("prefetching needs the decode cache (decode_cache_size > 0)")
+            return None
+        self.prefetcher = TrajectoryPrefetcher(
+            self, method=method, history=history, num_points=num_points)
+        return self.prefetcher
+
+    def prefetch(self, z: np.ndarray, temperature: float = 1.0) -> int:
+        """ decodes the rows of z that are not cached yet into the decode
+        cache, without counting them as live requests; returns how many """
+        if self.decode_cache is None or not self.ready:
+            return 0
+        z = z.reshape(-1, z.shape[-1])
+        keys = [self.decode_cache.key(row, self.max_seq_len, temperature) for row in z]
+        missing = [i for i, key in enumerate(keys) if key not in self.decode_cache]
+        if not missing:
+            return 0
+        tensors = self._decode_tensors(z[missing], temperature, stage="prefetch_run")
+        for i, tensor in zip(missing, tensors or []):
+            self.decode_cache.put(keys[i], Phrase(self.data_converter, tensor, mode=self.mode))
+            if self.prefetcher is not None:
+                self.prefetcher.mark_prefetched(keys[i])
+        return len(missing)
+
+    def midi_path(self, mode) -> str:
+        # microseconds keep two phrases of the same second from sharing a file
+        midi_file_name = datetime.now().strftime("%y%m%d_%H%M%S_%f")
+        return os.path.join(
+            self.midi_output_dir, "music_vae", f"{midi_file_name}_{mode}.mid")
 
     def write_midi(self, notes, mode) -> str:
-        midi_file_name = datetime.now().strftime("%y%m%d_%H%M%S")
-        midi_path = os.path.join(
-            self.midi_output_dir, "music_vae", f"{midi_file_name}_{mode}.mid")
+        midi_path = self.midi_path(mode)
         try:
             sequence_proto_to_midi_file(notes, midi_path)
             return midi_path
@@ -211,29 +488,76 @@ class MusicVAEModel(ModelInterface):
         self.update_previous_sequence(output)
         return output
 
-    def interpolate_from_sequence(self, input: NoteSequence,
-                                  noise_bias=-4) -> Optional[NoteSequence]:
+    def interpolate(self, points: Union[np.ndarray, List[np.ndarray]], num_steps: int = 8,
+                    method: str = "slerp",
+                    temperature: float = 1.0) -> Iterator[Optional[Phrase]]:
+        """ yields the `Phrase`s of `num_steps` points (both ends included)
+        between every pair of consecutive `points`, which are either 3dim z'
+        or full z (`decode_from_z`).
+
+        all points are computed at once and decoded `batch_size` at a time,
+        the next chunk being decoded while the phrases of the current one are
+        consumed, so the first steps can be sent before the last are decoded.
+
+        the model and the size of the points are checked when called, not
+        when the first phrase is requested """
+        if not self.model:
+            warn("MelodyRNN model not loaded!, call `MusicVAEModel.load_model()`")
+            return iter(())
+        path = interpolate_path(points, num_steps, method)
+        dims = [self.model.encoded_z_size] + ([self.model.z_size] if self.model.can_decode_z else [])
+        if path.shape[1] not in dims:
+            raise ValueError(f"can only interpolate z sized {dims}, got {path.shape[1]}")
+        return self._decode_path(path, temperature)
+
+    def _decode_path(self, path: np.ndarray, temperature: float) -> Iterator[Optional[Phrase]]:
+        chunk = self.model.batch_size
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="interpolate") as executor:
+            future = executor.submit(self.decode_phrases, path[:chunk], temperature)
+            for start in range(chunk, len(path) + chunk, chunk):
+                phrases = future.result()
+                if start < len(path):
+                    future = executor.submit(
+                        self.decode_phrases, path[start:start + chunk], temperature)
+                yield from phrases
+
+    def interpolate_from_sequence(self, input: NoteSequence, noise_bias=-4,
+                                  num_steps: int = 3) -> Optional[NoteSequence]:
+        """ decodes the middle of `num_steps` points from the previous
+        sequence to `input`, both encodings moved by noise of `noise_bias`
+        as in `generate_from_sequence`, and makes it the previous sequence """
         if self.previous_sequence is None:
             self.previous_sequence = input
-        if self.model:
-            sequence = self.model.interpolate(self.previous_sequence,
-                                              input, num_steps=1,
-                                              length=self.previous_length)[0]
-            self.latest_z = self.encode(sequence)
-            self.update_previous_sequence(sequence)
-            return sequence
+        if not self.model:
+            return None
+        try:
+            if self.model.can_decode_z:
+                _, mu, _ = self.model.encode([self.previous_sequence, input])
+            else:
+                mu = self.model.encode_latent([self.previous_sequence, input])
+        except Exception as e:
+            warn(f"Failed to encode sequences to interpolate: {e}")
+            return None
+        phrases = list(self.interpolate(mu + self.get_noise(mu, noise_bias), num_steps))
+        phrase = phrases[len(phrases) // 2]
+        if phrase is None:
+            return None
+        sequence = phrase.sequence
+        self.encode(sequence)
+        self.update_previous_sequence(sequence)
+        return sequence
 
     def generate_continuous(self, noise_bias=-4,
                             interporate=False) -> Optional[NoteSequence]:
 
         def get_decorded_output() -> Optional[NoteSequence]:
-            if self.latest_z:
+            if self.latest_z is not None:
                 noise = self.get_noise(self.latest_z, noise_bias)
                 z_dash = self.latest_z + noise
                 output = self.decode(z_dash)
                 self.update_previous_sequence(output)
                 if output and interporate:
-                    return self.interpolate_from_sequence(output)
+                    return self.interpolate_from_sequence(output, noise_bias)
                 return output
             else:
                 warn("Failed to update `latest_z` by encoding Sequence")
@@ -248,6 +572,28 @@ class MusicVAEModel(ModelInterface):
             warn("previous generated note data not found")
             return
 
+    def next_continuous_phrase(self, noise_bias=-4,
+                               temperature: float = 1.0,
+                               z: Optional[np.ndarray] = None) -> Optional[Phrase]:
+        """ `Phrase` of `z` (by default `latest_z`) plus a little noise, the next
+        one of a continuous stream (see `continuous.ContinuousGenerator`).
+
+        the noise is far below the step of the decode cache and the latent
+        grid, so both are skipped: every phrase is sampled anew instead of
+        repeating the one of the nearest key """
+        if z is None:
+            z = self.latest_z
+        if z is None:
+            return None
+        z = z + self.get_noise(z, noise_bias)
+        return self.decode_phrases(z.reshape(-1, z.shape[-1])[:1], temperature,
+                                   cached=False)[0]
+
+    @property
+    def phrase_seconds(self) -> float:
+        """ how long one decoded phrase plays at the default tempo """
+        return phrase_seconds(self.data_converter, self.max_seq_len)
+
     def get_noise(self, z: np.ndarray, noise_bias: float = -4.0) -> np.ndarray:
         return np.random.randn(*z.shape) * 10**(noise_bias)
 
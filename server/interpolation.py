@@ -0,0 +1,56 @@
+from typing import Sequence, Union
+
+import numpy as np
+
+# how the points between two latent points are placed
+INTERPOLATION_METHODS = ("lerp", "slerp")
+
+
+def lerp(p0: np.ndarray, p1: np.ndarray, ts: np.ndarray) -> np.ndarray:
+    """ `[..., len(ts), dim]` points on the lines from p0 to p1 (`[..., dim]`) """
+    ts = np.asarray(ts, dtype=np.float64)[:, np.newaxis]
+    p0 = np.asarray(p0, dtype=np.float64)[..., np.newaxis, :]
+    p1 = np.asarray(p1, dtype=np.float64)[..., np.newaxis, :]
+    return (1.0 - ts) * p0 + ts * p1
+
+
+def slerp(p0: np.ndarray, p1: np.ndarray, ts: np.ndarray) -> np.ndarray:
+    """ spherical counterpart of `lerp`, as MusicVAE interpolates; pairs
+    that are (anti)parallel or at the origin fall back to `lerp` """
+    p0 = np.asarray(p0, dtype=np.float64)
+    p1 = np.asarray(p1, dtype=np.float64)
+    ts = np.asarray(ts, dtype=np.float64)
+    n0 = np.linalg.norm(p0, axis=-1, keepdims=True)
+    n1 = np.linalg.norm(p1, axis=-1, keepdims=True)
+    cos = np.sum(p0 / np.where(n0 == 0, 1, n0) * p1 / np.where(n1 == 0, 1, n1),
+                 axis=-1, keepdims=True)
+    omega = np.arccos(np.clip(cos, -1.0, 1.0))[..., np.newaxis, :]  # [..., 1, 1]
+    so = np.sin(omega)
+    degenerate = (np.abs(so) < 1e-6) | ((n0 == 0) | (n1 == 0))[..., np.newaxis, :]
+    so = np.where(degenerate, 1.0, so)
+    w0 = np.where(degenerate, 1.0 - ts[:, np.newaxis], np.sin((1.0 - ts[:, np.newaxis]) * omega) / so)
+    w1 = np.where(degenerate, ts[:, np.newaxis], np.sin(ts[:, np.newaxis] * omega) / so)
+    return w0 * p0[..., np.newaxis, :] + w1 * p1[..., np.newaxis, :]
+
+
+def interpolate_path(points: Union[np.ndarray, Sequence[np.ndarray]], num_steps: int,
+                     method: str = "slerp") -> np.ndarray:
+    """ `num_steps` points (both ends included) between every pair of
+    consecutive `points`, all segments computed at once.
+
+    returns a float32 array sized `[(len(points) - 1) * (num_steps - 1) + 1, dim]`
+    that goes through every point of `points` in order """
+    assert method in INTERPOLATION_METHODS, \
+        f"interpolation method must be one of {INTERPOLATION_METHODS}, got {method}"
+    points = np.asarray(points, dtype=np.float64)
+    points = points.reshape(points.shape[0], -1)
+    if len(points) < 2:
+        raise ValueError(f"need at least 2 points to interpolate, got {len(points)}")
+    if num_steps < 2:
+        raise ValueError(f"num_steps includes both ends and must be >= 2, got {num_steps}")
+    # every segment without its end point, which is the start of the next one
+    ts = np.linspace(0.0, 1.0, num_steps)[:-1]
+    func = slerp if method == "slerp" else lerp
+    segments = func(points[:-1], points[1:], ts)  # [len(points) - 1, num_steps - 1, dim]
+    path = np.concatenate([segments.reshape(-1, points.shape[1]), points[-1:]])
+    return path.astype(np.float32)
@@ -1,6 +1,9 @@
 import argparse
+import asyncio
 import logging
-from logging import info, debug
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from logging import info, debug, warn
 import os
 import sys
 from datetime import datetime
@@ -9,11 +12,17 @@ from typing import Optional
 import yaml
 from note_seq.protobuf.music_pb2 import NoteSequence
 
+from continuous import SessionContinuous, start_continuous
 from converter import ReceivedNotesManager
 from event_handlers import (on_output_midi_file_func,
-                            on_output_note_sequence_func)
+                            on_output_note_sequence_func,
+                            on_output_note_sequences_func)
 from generator import MusicVAEModel
-from osc import OSCSender, OSCServer
+from metrics import METRICS, StatsReporter
+from midi_writer import QUEUE_POLICIES, MidiWriter
+from osc import PAYLOAD_FORMATS, OSCSender, OSCServer
+from prefetch import PREDICTION_METHODS
+from session import SessionRegistry
 
 sys.path.append(os.path.dirname(__file__))
 with open(os.path.join(os.path.dirname(__file__), "..", "config.yml"), 'r') as yml:
@@ -35,47 +44,287 @@ if __name__ == "__main__":
     parser.add_argument("---receive_port", type=int,
                         default=CONFIG["osc"]["receive_port"],
                         help="The port to receive on")
+    parser.add_argument('--asyncio', action='store_true',
+                        help="serve from an asyncio event loop (several ports, clean shutdown); implies --coalesce so decodes stay off the loop")
+    parser.add_argument('--extra_receive_ports', type=str, default="",
+                        help="comma separated additional ports to receive on (with --asyncio)")
     parser.add_argument('--separate_mode', action='store_true',
                         help="if you do not run python process via M4L device")
+    parser.add_argument('--osc_payload', choices=PAYLOAD_FORMATS, default="string",
+                        help="format of /generated_notes_*: token string or typed iiff arguments")
+    parser.add_argument('--skip_midi', action='store_true',
+                        help="do not write MIDI files, only send the notes over OSC")
+    parser.add_argument('--midi_writer_threads', type=int, default=1,
+                        help="threads writing MIDI files in the background (0: write on the serving thread)")
+    parser.add_argument('--midi_queue_size', type=int, default=8,
+                        help="MIDI files waiting to be written before --midi_queue_policy applies")
+    parser.add_argument('--midi_queue_policy', choices=QUEUE_POLICIES, default="drop_oldest",
+                        help="what to do with a new MIDI file when the queue is full")
+    parser.add_argument('--sessions', action='store_true',
+                        help="keep state and replies per client (address or client id), decode clients together")
+    parser.add_argument('--coalesce', action='store_true',
+                        help="decode only the newest z per mode and drop stale ones")
+    parser.add_argument('--per_mode_workers', action='store_true',
+                        help="decode drums, mel and bass on their own worker threads")
+    parser.add_argument('--intra_op_threads', type=str, default="0",
+                        help="TF intra-op threads of every model session, or of drums,mel,bass "
+                             "comma separated, e.g. 1,2,4 to share the cores of --parallel_load (0: auto)")
+    parser.add_argument('--inter_op_threads', type=str, default="0",
+                        help="TF inter-op threads of every model session, or of drums,mel,bass "
+                             "comma separated (0: auto)")
+    parser.add_argument('--use_latent_grid', action='store_true',
+                        help="answer z from the precomputed grids in config.yml")
+    parser.add_argument('--latent_grid_blend', action='store_true',
+                        help="blend neighbouring grid voxels instead of the nearest one")
+    parser.add_argument('--decode_cache_size', type=int, default=0,
+                        help="number of decodes kept per model for repeated z (0: off)")
+    parser.add_argument('--decode_cache_step', type=float, default=0.05,
+                        help="z quantization step used as the decode cache key")
+    parser.add_argument('--batch_window_ms', type=float, default=0.0,
+                        help="collect decodes arriving within this window into one batch (0: off)")
+    parser.add_argument('--speculative_radius', type=float, default=0.0,
+                        help="fill spare batch rows with neighbours this far from z (needs the decode cache)")
+    parser.add_argument('--prefetch', choices=PREDICTION_METHODS, default=None,
+                        help="decode the z predicted from each performer's trajectory ahead (needs the decode cache)")
+    parser.add_argument('--prefetch_points', type=int, default=2,
+                        help="predicted z decoded ahead per request")
+    parser.add_argument('--prefetch_history', type=int, default=4,
+                        help="recent z the prediction is made from")
+    parser.add_argument('--batch_size', type=int, default=4,
+                        help="largest number of z decoded by one sess.run")
+    parser.add_argument('--batch_buckets', type=str, default="1",
+                        help="comma separated smaller batch sizes to build decode ops for")
+    parser.add_argument('--skip_z_decoder', action='store_true',
+                        help="do not build decode ops for full z (faster startup)")
+    parser.add_argument('--skip_encoder', action='store_true',
+                        help="do not build the encoder (faster startup, no encode/interpolate)")
+    parser.add_argument('--checkpoint_cache_dir', type=str, default=None,
+                        help="directory tar checkpoints are unbundled into (default ~/.cache/midime/checkpoints)")
+    parser.add_argument('--use_frozen_graph', action='store_true',
+                        help="load the frozen graphs in config.yml instead of the checkpoints")
+    parser.add_argument('--parallel_load', action='store_true',
+                        help="load the models concurrently and start serving once the first is ready")
+    parser.add_argument('--skip_warmup', action='store_true',
+                        help="do not run dummy decodes after loading (the first live decode will be slow)")
+    parser.add_argument('--warmup_lengths', type=str, default="",
+                        help="comma separated decode lengths to warm up (default: each model's max_seq_len)")
+    parser.add_argument('--continuous', action='store_true',
+                        help="keep phrases of the latest z decoded ahead and send each just before it plays (needs --separate_mode; one stream per client with --sessions)")
+    parser.add_argument('--qpm', type=float, default=120.0,
+                        help="tempo of --continuous")
+    parser.add_argument('--lookahead', type=int, default=2,
+                        help="phrases per mode decoded ahead in --continuous")
+    parser.add_argument('--send_ahead_ms', type=float, default=50.0,
+                        help="how long before it plays a --continuous phrase is sent")
+    parser.add_argument('--stats_interval', type=float, default=0.0,
+                        help="log the p50/p95/p99 latency of every stage this often, in seconds (0: off)")
+    parser.add_argument('--serve_stats', action='store_true',
+                        help="answer /stats with the stage latencies as JSON")
+    parser.add_argument('--stats_window', type=int, default=512,
+                        help="number of recent samples the latency percentiles are taken over")
     parser.add_argument('--verbose', action='store_true',
                         help="log level")
     args = parser.parse_args()
+    if args.prefetch and args.decode_cache_size <= 0:
+        parser.error("--prefetch needs --decode_cache_size > 0")
+    if args.speculative_radius > 0 and args.decode_cache_size <= 0:
+        parser.error("--speculative_radius needs --decode_cache_size > 0")
+    if args.continuous and not args.separate_mode:
+        parser.error("--continuous needs --separate_mode")
 
     logging.basicConfig(
         format='%(levelname)s: %(message)s', level=logging.DEBUG if args.verbose else logging.INFO)
 
+    batch_buckets = [int(b) for b in args.batch_buckets.split(",") if b]
+    # one value for every model, or one per mode in drums, mel, bass order
+    threads = {}
+    for flag in ("intra_op_threads", "inter_op_threads"):
+        values = [int(n) for n in getattr(args, flag).split(",") if n] or [0]
+        if len(values) not in (1, 3):
+            parser.error(f"--{flag} takes one value or three (drums,mel,bass)")
+        threads[flag] = dict(zip(("drums", "mel", "bass"), values * 3 if len(values) == 1 else values))
+    warmup_lengths = [int(n) for n in args.warmup_lengths.split(",") if n] or None
+
     print("=" * 40)
     info("Creating OSC server...")
     server = OSCServer(args.receive_address, args.receive_port)
-    server.data_manager = ReceivedNotesManager()
+    # with --asyncio the handlers run on the event loop, so decodes always go
+    # through the mailbox workers instead of blocking every port
+    server.data_manager = ReceivedNotesManager(
+        coalesce=args.coalesce or args.sessions or args.asyncio,
+        per_mode_workers=args.per_mode_workers)
     # TODO: hard coded send port num, change it
     # server.bypass_sender = OSCSender(args.send_address, 6565)
     vae_drums = MusicVAEModel(
         CONFIG["model_path_vae_drums"], CONFIG["model_path_midime_drums"],
-        "cat-drums_2bar_small", "cat-drums_2bar_small_3dim")
+        "cat-drums_2bar_small", "cat-drums_2bar_small_3dim",
+        intra_op_threads=threads["intra_op_threads"]["drums"],
+        inter_op_threads=threads["inter_op_threads"]["drums"],
+        decode_cache_size=args.decode_cache_size,
+        decode_cache_step=args.decode_cache_step,
+        batch_window_sec=args.batch_window_ms / 1000,
+        speculative_radius=args.speculative_radius,
+        batch_size=args.batch_size,
+        batch_buckets=batch_buckets,
+        decode_from_z=not args.skip_z_decoder,
+        build_encoder=not args.skip_encoder,
+        checkpoint_cache_dir=args.checkpoint_cache_dir,
+        frozen_graph_path=CONFIG["frozen_graph_path_drums"] if args.use_frozen_graph else None,
+        mode="drums",
+        warmup=not args.skip_warmup,
+        warmup_lengths=warmup_lengths)
     vae_mel = MusicVAEModel(
         CONFIG["model_path_vae_mel"], CONFIG["model_path_midime_mel"],
-        "cat-mel_2bar_big", "cat-mel_2bar_big_3dim")
+        "cat-mel_2bar_big", "cat-mel_2bar_big_3dim",
+        intra_op_threads=threads["intra_op_threads"]["mel"],
+        inter_op_threads=threads["inter_op_threads"]["mel"],
+        decode_cache_size=args.decode_cache_size,
+        decode_cache_step=args.decode_cache_step,
+        batch_window_sec=args.batch_window_ms / 1000,
+        speculative_radius=args.speculative_radius,
+        batch_size=args.batch_size,
+        batch_buckets=batch_buckets,
+        decode_from_z=not args.skip_z_decoder,
+        build_encoder=not args.skip_encoder,
+        checkpoint_cache_dir=args.checkpoint_cache_dir,
+        frozen_graph_path=CONFIG["frozen_graph_path_mel"] if args.use_frozen_graph else None,
+        mode="mel",
+        warmup=not args.skip_warmup,
+        warmup_lengths=warmup_lengths)
     vae_bass = MusicVAEModel(
         CONFIG["model_path_vae_bass"], CONFIG["model_path_midime_bass"],
-        "hierdec-trio_16bar", "hierdec-trio_16bar_3dim")
-    vae_drums.load_model()
-    vae_mel.load_model()
-    vae_bass.load_model()
+        "hierdec-trio_16bar", "hierdec-trio_16bar_3dim",
+        intra_op_threads=threads["intra_op_threads"]["bass"],
+        inter_op_threads=threads["inter_op_threads"]["bass"],
+        decode_cache_size=args.decode_cache_size,
+        decode_cache_step=args.decode_cache_step,
+        batch_window_sec=args.batch_window_ms / 1000,
+        speculative_radius=args.speculative_radius,
+        batch_size=args.batch_size,
+        batch_buckets=batch_buckets,
+        decode_from_z=not args.skip_z_decoder,
+        build_encoder=not args.skip_encoder,
+        checkpoint_cache_dir=args.checkpoint_cache_dir,
+        frozen_graph_path=CONFIG["frozen_graph_path_bass"] if args.use_frozen_graph else None,
+        mode="bass",
+        warmup=not args.skip_warmup,
+        warmup_lengths=warmup_lengths)
+
+    midi_writer = None
+    if not args.skip_midi and args.midi_writer_threads > 0:
+        midi_writer = MidiWriter(args.midi_writer_threads, args.midi_queue_size,
+                                 policy=args.midi_queue_policy)
+    output_options = dict(midi_writer=midi_writer, write_midi=not args.skip_midi)
 
+    sender: Optional[OSCSender] = None
     if args.separate_mode:  # run mannually via shell
-        sender = OSCSender(args.send_address, args.send_port)
+        sender = OSCSender(args.send_address, args.send_port,
+                           payload_format=args.osc_payload)
         print(
             f"Results will be sent to {args.send_address}, port: {args.send_port}")
         server.data_manager.on_output_drums = on_output_note_sequence_func(
-            vae_drums, osc_sender=sender)
+            vae_drums, osc_sender=sender, **output_options)
         server.data_manager.on_output_mel = on_output_note_sequence_func(
-            vae_mel, osc_sender=sender)
+            vae_mel, osc_sender=sender, **output_options)
         server.data_manager.on_output_bass = on_output_note_sequence_func(
-            vae_bass, osc_sender=sender)
+            vae_bass, osc_sender=sender, **output_options)
     else:  # run this from nodejs runtime on Max for Live Device
-        server.data_manager.on_output_drums = on_output_note_sequence_func(vae_drums)
-        server.data_manager.on_output_mel = on_output_note_sequence_func(vae_mel)
-        server.data_manager.on_output_bass = on_output_note_sequence_func(vae_bass)
+        server.data_manager.on_output_drums = on_output_note_sequence_func(
+            vae_drums, **output_options)
+        server.data_manager.on_output_mel = on_output_note_sequence_func(
+            vae_mel, **output_options)
+        server.data_manager.on_output_bass = on_output_note_sequence_func(
+            vae_bass, **output_options)
+
+    if args.sessions:
+        # replies go to each client's own address; the models are shared and
+        # the z of clients waiting for the same model are decoded together
+        server.sessions = SessionRegistry(args.send_port, payload_format=args.osc_payload)
+        for mode, vae in [("drums", vae_drums), ("mel", vae_mel), ("bass", vae_bass)]:
+            server.data_manager.on_output_batch[mode] = on_output_note_sequences_func(
+                vae, osc_sender=sender, **output_options)
+
+    def load(mode: str) -> MusicVAEModel:
+        vae = models[mode]
+        vae.load_model()
+        if args.use_latent_grid:
+            vae.load_latent_grid(
+                CONFIG[f"latent_grid_path_{mode}"], blend=args.latent_grid_blend)
+        return vae
+
+    models = {"drums": vae_drums, "mel": vae_mel, "bass": vae_bass}
+    if args.prefetch:
+        for vae in models.values():
+            vae.enable_prefetch(args.prefetch, history=args.prefetch_history,
+                                num_points=args.prefetch_points)
+    start = time.perf_counter()
+    if args.parallel_load:
+        # every TrainedModel builds its own graph and session, so they load side by side;
+        # the rest keep loading after the server started and reply not ready until then
+        loader = ThreadPoolExecutor(max_workers=len(models), thread_name_prefix="load-model")
+        futures = {loader.submit(load, mode): mode for mode in models}
+        first = None
+        for future in as_completed(futures):
+            try:
+                if future.result().ready:
+                    first = futures[future]
+                    break
+            except Exception as e:
+                warn(f"Failed to load {futures[future]} model: {e}")
+        loader.shutdown(wait=False)
+        if first is None:
+            warn("No model could be loaded, exiting")
+            sys.exit(1)
+        info(f"First model ({first}) ready in {time.perf_counter() - start:.1f}s")
+    else:
+        for mode in models:
+            load(mode)
+        info(f"Models loaded in {time.perf_counter() - start:.1f}s")
+
+    METRICS.window = args.stats_window
+    server.serve_stats = args.serve_stats
+    reporter = None
+    if args.stats_interval > 0:
+        reporter = StatsReporter(METRICS, args.stats_interval)
+        reporter.start()
+
+    continuous = {}
+    continuous_options = dict(qpm=args.qpm, lookahead=args.lookahead,
+                              send_ahead_sec=args.send_ahead_ms / 1000)
+    if args.continuous and server.sessions is not None:
+        # every session streams from its own position, so z are not batched
+        router = SessionContinuous(models, sender, **continuous_options)
+        continuous = {"sessions": router}
+        server.data_manager.on_output_batch.clear()
+        for mode in models:
+            setattr(server.data_manager, f"on_output_{mode}", router.update)
+    elif args.continuous:
+        # z only moves the position, the phrases are decoded ahead of time
+        continuous = start_continuous(models, sender, **continuous_options)
+        for mode, generator in continuous.items():
+            setattr(server.data_manager, f"on_output_{mode}", generator.update)
+
+    server.data_manager.start()
     print("Starting server process...")
-    server.run(single_thread=True)
+    if args.asyncio:
+        extra_ports = [int(p) for p in args.extra_receive_ports.split(",") if p]
+        try:
+            asyncio.run(server.run_async(extra_ports, senders=[sender] if sender else []))
+        finally:
+            server.data_manager.stop()
+            if midi_writer is not None:
+                midi_writer.close()
+            if server.sessions is not None:
+                server.sessions.close()
+            for generator in continuous.values():
+                generator.stop()
+            for mode, vae in models.items():
+                if vae.prefetcher is not None:
+                    info(f"{mode} prefetch: {vae.prefetcher.stats()}")
+                    vae.prefetcher.close()
+            if reporter is not None:
+                reporter.stop()
+                info(METRICS.summary())
+            print("Server stopped")
+    else:
+        server.run(single_thread=True)
@@ -0,0 +1,102 @@
+import collections
+import json
+import threading
+import time
+from contextlib import contextmanager
+from logging import info
+from typing import Deque, Dict, Iterator, Tuple
+
+import numpy as np
+
+# stages of one request, in pipeline order
+STAGES = ("parse", "queue_wait", "sess_run", "notes", "tokens", "send",
+          "from_tensors", "midi_write", "prefetch_run")
+PERCENTILES = (50, 95, 99)
+
+
+class LatencyStats:
+    """ rolling latency samples per (stage, mode).
+
+    every stage keeps its last `window` durations, so the percentiles follow
+    the current load instead of averaging over the whole set. recording is a
+    lock and a deque append, cheap enough for the serving path.
+    """
+
+    def __init__(self, window: int = 512) -> None:
+        self.window = window
+        self.enabled = True
+        self._samples: Dict[Tuple[str, str], Deque[float]] = {}
+        self._counts: Dict[Tuple[str, str], int] = collections.Counter()
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, mode: str, seconds: float) -> None:
+        if not self.enabled:
+            return
+        key = (stage, mode)
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = collections.deque(maxlen=self.window)
+            samples.append(seconds)
+            self._counts[key] += 1
+
+    @contextmanager
+    def span(self, stage: str, mode: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, mode, time.perf_counter() - start)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._samples.clear()
+            self._counts.clear()
+
+    def percentiles(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """ `{mode: {stage: {"count", "p50", "p95", "p99"}}}` in milliseconds """
+        with self._lock:
+            snapshot = {key: np.array(samples) for key, samples in self._samples.items()}
+            counts = dict(self._counts)
+        order = {stage: i for i, stage in enumerate(STAGES)}
+        result: Dict[str, Dict[str, Dict[str, float]]] = {}
+        for (stage, mode), samples in sorted(
+                snapshot.items(), key=lambda kv: (kv[0][1], order.get(kv[0][0], len(order)))):
+            values = np.percentile(samples * 1000, PERCENTILES)
+            entry = {"count": counts[(stage, mode)]}
+            entry.update({f"p{p}": round(float(v), 3) for p, v in zip(PERCENTILES, values)})
+            result.setdefault(mode, {})[stage] = entry
+        return result
+
+    def summary(self) -> str:
+        """ one log line: `mode stage=p50/p95/p99ms ...` per mode """
+        parts = []
+        for mode, stages in self.percentiles().items():
+            spans = " ".join(f"{stage}={s['p50']:.1f}/{s['p95']:.1f}/{s['p99']:.1f}"
+                             for stage, s in stages.items())
+            parts.append(f"[{mode}] {spans}")
+        return "latency p50/p95/p99 ms " + " ".join(parts) if parts else "latency: no samples"
+
+    def to_json(self) -> str:
+        return json.dumps(self.percentiles())
+
+
+class StatsReporter(threading.Thread):
+    """ logs `stats.summary()` every `interval_sec` """
+
+    def __init__(self, stats: LatencyStats, interval_sec: float) -> None:
+        super().__init__(name="stats-reporter", daemon=True)
+        self.stats = stats
+        self.interval_sec = interval_sec
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval_sec):
+            info(self.stats.summary())
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+
+# shared by every stage of the server process
+METRICS = LatencyStats()
@@ -0,0 +1,143 @@
+import collections
+import os
+import tempfile
+import threading
+from logging import debug, warn
+from typing import Callable, Dict, List, Optional
+
+from note_seq import sequence_proto_to_midi_file
+from note_seq.protobuf.music_pb2 import NoteSequence
+
+from metrics import METRICS
+
+# what `submit` does when the queue is full
+QUEUE_POLICIES = ("block", "drop_oldest", "drop_newest")
+
+# `mode` tags the `midi_write` latency span
+MidiJob = collections.namedtuple("MidiJob", ["get_sequence", "path", "on_done", "mode"],
+                                 defaults=["-"])
+
+
+def write_midi_durable(sequence: NoteSequence, path: str) -> None:
+    """ writes next to `path`, fsyncs and renames, so that a reader given
+    `path` never sees a partly written file """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # a unique name per call, so concurrent writes to one path don't clobber
+    # each other's temporary file
+    fd, tmp_path = tempfile.mkstemp(suffix=".mid.tmp", dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        sequence_proto_to_midi_file(sequence, tmp_path)
+        with open(tmp_path, "rb+") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class MidiWriter:
+    """ writes MIDI files on background threads off the serving path.
+
+    jobs wait in a queue of `max_queue`; when it is full `policy` either
+    blocks the caller (`block`), drops the oldest waiting job (`drop_oldest`)
+    or drops the new one (`drop_newest`). `on_done` is called on the writer
+    thread with the path once the file is durable, or with "" if the job
+    failed or was dropped.
+    """
+
+    def __init__(self, num_threads: int = 1, max_queue: int = 8,
+                 policy: str = "drop_oldest") -> None:
+        assert policy in QUEUE_POLICIES, \
+            f"policy must be one of {QUEUE_POLICIES}, got {policy}"
+        self.max_queue = max_queue
+        self.policy = policy
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self._queue: collections.deque = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._threads: List[threading.Thread] = [
+            threading.Thread(target=self._run, name=f"midi-writer-{i}", daemon=True)
+            for i in range(num_threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, get_sequence: Callable[[], NoteSequence], path: str,
+               on_done: Optional[Callable[[str], None]] = None,
+               mode: str = "-") -> bool:
+        """ queues a file; `get_sequence` is called on the writer thread so that
+        building the NoteSequence is off the serving path too.
+        returns False if the job was dropped """
+        job = MidiJob(get_sequence, path, on_done, mode)
+        dropped: Optional[MidiJob] = None
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("MidiWriter is closed")
+            if len(self._queue) >= self.max_queue:
+                if self.policy == "block":
+                    self._cond.wait_for(
+                        lambda: self._closed or len(self._queue) < self.max_queue)
+                    if self._closed:
+                        raise RuntimeError("MidiWriter is closed")
+                elif self.policy == "drop_oldest":
+                    dropped = self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    self.dropped += 1
+                    dropped = job
+            if dropped is not job:
+                self._queue.append(job)
+                self._cond.notify_all()
+        if dropped is not None:
+            debug(f"midi writer queue full, dropped {dropped.path}")
+            self._done(dropped, "")
+        return dropped is not job
+
+    def close(self) -> None:
+        """ writes the files still queued and stops the threads """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {"queued": len(self._queue),
+                    "written": self.written,
+                    "dropped": self.dropped,
+                    "failed": self.failed}
+
+    def _done(self, job: MidiJob, path: str) -> None:
+        if job.on_done is None:
+            return
+        try:
+            job.on_done(path)
+        except Exception as e:
+            warn(f"midi writer callback failed for {job.path}: {e}")
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed or self._queue)
+                if not self._queue:
+                    return
+                job = self._queue.popleft()
+                self._cond.notify_all()
+            try:
+                sequence = job.get_sequence()
+                with METRICS.span("midi_write", job.mode):
+                    write_midi_durable(sequence, job.path)
+            except Exception as e:
+                warn(f"Failed to generate and write midi file to: {job.path} ({e})")
+                with self._cond:
+                    self.failed += 1
+                self._done(job, "")
+                continue
+            with self._cond:
+                self.written += 1
+            self._done(job, job.path)
@@ -1,23 +1,60 @@
 import argparse
+import asyncio
+import functools
 import math
 import os
+import signal
 import sys
 import threading
 import warnings
 from datetime import date, datetime
 from time import time
-from typing import Any, Callable, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
 
 import numpy as np
-import yaml
 from pythonosc import udp_client
 from pythonosc.dispatcher import Dispatcher
-from pythonosc.osc_server import BlockingOSCUDPServer
+from pythonosc.osc_message_builder import OscMessageBuilder
+from pythonosc.osc_server import AsyncIOOSCUDPServer, BlockingOSCUDPServer
 
 from converter import ReceivedNotesManager
+from metrics import METRICS, LatencyStats
 
-with open(os.path.join(os.path.dirname(__file__), "..", "config.yml"), 'r') as yml:
-    CONFIG = yaml.safe_load(yml)
+
+# one note as OSC arguments: int32 pitch, int32 velocity, float32 start_ms, float32 end_ms
+NOTE_DTYPE = np.dtype([("pitch", ">i4"), ("velocity", ">i4"),
+                       ("start_ms", ">f4"), ("end_ms", ">f4")])
+# string: space separated tokens, typed: `iiff` per note (read by addNoteList of Max/seq_to_json.js)
+PAYLOAD_FORMATS = ("string", "typed")
+
+
+class _Datagram(NamedTuple):
+    """ prebuilt OSC message, accepted by `UDPClient.send` """
+    dgram: bytes
+
+
+def _osc_string(s: str) -> bytes:
+    b = s.encode("utf-8") + b"\0"
+    return b + b"\0" * (-len(b) % 4)
+
+
+def pack_notes(notes: np.ndarray) -> bytes:
+    """ `[n, 4]` pitch, velocity, start_ms, end_ms array as big-endian OSC arguments """
+    packed = np.empty(len(notes), dtype=NOTE_DTYPE)
+    if len(notes):
+        packed["pitch"] = notes[:, 0]
+        packed["velocity"] = notes[:, 1]
+        packed["start_ms"] = notes[:, 2]
+        packed["end_ms"] = notes[:, 3]
+    return packed.tobytes()
+
+
+def notes_message(path: str, notes: np.ndarray, payload_format: str) -> bytes:
+    """ OSC message of a note array, built without formatting any number """
+    data = pack_notes(notes)
+    if payload_format == "typed":
+        return _osc_string(path) + _osc_string("," + "iiff" * len(notes)) + data
+    raise ValueError(f"unknown binary payload format: {payload_format}")
 
 
 class OSCServer:
@@ -27,15 +64,27 @@ class OSCServer:
         self.address_z_mel = "/z_mel"
         self.address_z_bass = "/z_bass"
         self.address_z_drums = "/z_drums"
+        # `client_id reply_port`: where the replies of a session go
+        self.address_session = "/session"
+        # `[reply_port]`: replies with the latency percentiles as JSON
+        self.address_stats = "/stats"
 
         self.ip = ip
         self.port = port
         # self.timeout = timeout_seconds
 
         self.data_manager: Optional[ReceivedNotesManager] = None
+        # `session.SessionRegistry`; z is then routed per client
+        self.sessions: Optional[Any] = None
+        # stage latencies; `/stats` is only answered when `serve_stats` is set
+        self.stats: LatencyStats = METRICS
+        self.serve_stats = False
         # self.on_received: Optional[Callable[[
         #     int, datetime, int, float], Any]] = None
         self.server: Optional[BlockingOSCUDPServer] = None
+        # asyncio mode (`run_async`)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop: Optional[asyncio.Event] = None
 
         # self.bypass_sender: Optional[OSCSender] = None
 
@@ -58,49 +107,97 @@ class OSCServer:
 
         if self.data_manager:
             if callable(self.data_manager.receive):
-                xyz = self.parse_message(args)
-                xyz_ndarray = np.array(xyz, dtype=np.float32).reshape([1, 3])
-                xyz_ndarray = np.dot(xyz_ndarray, 6)
+                with self.stats.span("parse", 'all'):
+                    xyz = self.parse_message(args)
+                    xyz_ndarray = np.array(xyz, dtype=np.float32).reshape([1, 3])
+                    xyz_ndarray = np.dot(xyz_ndarray, 6)
 
                 self.data_manager.receive(xyz_ndarray, 'all')
 
     def _on_received_drums(self, unused_addr, args, *values) -> None:
         if self.data_manager:
             if callable(self.data_manager.receive):
-                xyz = self.parse_message(args)
-                xyz_ndarray = np.array(xyz, dtype=np.float32).reshape([1, 3])
-                xyz_ndarray = np.dot(xyz_ndarray, 6)
+                with self.stats.span("parse", 'drums'):
+                    xyz = self.parse_message(args)
+                    xyz_ndarray = np.array(xyz, dtype=np.float32).reshape([1, 3])
+                    xyz_ndarray = np.dot(xyz_ndarray, 6)
 
                 self.data_manager.receive(xyz_ndarray, 'drums')
 
     def _on_received_mel(self, unused_addr, args, *values) -> None:
         if self.data_manager:
             if callable(self.data_manager.receive):
-                xyz = self.parse_message(args)
-                xyz_ndarray = np.array(xyz, dtype=np.float32).reshape([1, 3])
-                xyz_ndarray = np.dot(xyz_ndarray, 6)
+                with self.stats.span("parse", 'mel'):
+                    xyz = self.parse_message(args)
+                    xyz_ndarray = np.array(xyz, dtype=np.float32).reshape([1, 3])
+                    xyz_ndarray = np.dot(xyz_ndarray, 6)
 
                 self.data_manager.receive(xyz_ndarray, 'mel')
 
     def _on_received_bass(self, unused_addr, args, *values) -> None:
         if self.data_manager:
             if callable(self.data_manager.receive):
-                xyz = self.parse_message(args)
-                xyz_ndarray = np.array(xyz, dtype=np.float32).reshape([1, 3])
-                xyz_ndarray = np.dot(xyz_ndarray, 6)
+                with self.stats.span("parse", 'bass'):
+                    xyz = self.parse_message(args)
+                    xyz_ndarray = np.array(xyz, dtype=np.float32).reshape([1, 3])
+                    xyz_ndarray = np.dot(xyz_ndarray, 6)
 
                 self.data_manager.receive(xyz_ndarray, 'bass')
 
-    def run(self, single_thread=False) -> None:
-        self.dispatcher = Dispatcher()
+    def _on_received_session_z(self, mode: str, client_address: Tuple[str, int],
+                               unused_addr, args, *values) -> None:
+        """ `x y z [client_id]` (or the client id as a second argument) from
+        one of several clients; without an id the sender address is used """
+        if self.data_manager and self.sessions is not None:
+            with self.stats.span("parse", mode):
+                xyz: List[str] = args.split(" ")
+                assert len(xyz) in (3, 4), \
+                    f"length of input OSC message not matches, expected 3 or 4 but got {len(xyz)}"
+                client_id = xyz[3] if len(xyz) == 4 else (str(values[0]) if values else None)
+                session = self.sessions.get(client_id, client_address)
+                xyz_ndarray = np.array(xyz[:3], dtype=np.float32).reshape([1, 3])
+                xyz_ndarray = np.dot(xyz_ndarray, 6)
 
-        try:
-            # register receive notes event callback
-            self.dispatcher.map(self.address_z_all, self._on_received_all)
-            self.dispatcher.map(self.address_z_mel, self._on_received_mel)
-            self.dispatcher.map(self.address_z_bass, self._on_received_bass)
-            self.dispatcher.map(self.address_z_drums, self._on_received_drums)
+            self.data_manager.receive(xyz_ndarray, mode, session)
+
+    def _on_received_session(self, client_address: Tuple[str, int],
+                             unused_addr, args, *values) -> None:
+        if self.sessions is not None:
+            client_id, port = args.split(" ")
+            session = self.sessions.set_reply_port(client_id, client_address, int(port))
+            print(f"session registered: {session}")
+
+    def _on_received_stats(self, client_address: Tuple[str, int],
+                           unused_addr, *values) -> None:
+        """ answers `/stats` with `{mode: {stage: {count, p50, p95, p99}}}`
+        (milliseconds) to the sender, or to `reply_port` on the sender's host """
+        port = int(values[0]) if values else client_address[1]
+        client = udp_client.SimpleUDPClient(client_address[0], port)
+        client.send_message(self.address_stats, self.stats.to_json())
+
+    def _create_dispatcher(self) -> Dispatcher:
+        dispatcher = Dispatcher()
+        if self.serve_stats:
+            dispatcher.map(self.address_stats, self._on_received_stats,
+                           needs_reply_address=True)
+        if self.sessions is not None:
+            for address, mode in [(self.address_z_all, 'all'), (self.address_z_mel, 'mel'),
+                                  (self.address_z_bass, 'bass'), (self.address_z_drums, 'drums')]:
+                dispatcher.map(address, functools.partial(self._on_received_session_z, mode),
+                               needs_reply_address=True)
+            dispatcher.map(self.address_session, self._on_received_session,
+                           needs_reply_address=True)
+            return dispatcher
+        # register receive notes event callback
+        dispatcher.map(self.address_z_all, self._on_received_all)
+        dispatcher.map(self.address_z_mel, self._on_received_mel)
+        dispatcher.map(self.address_z_bass, self._on_received_bass)
+        dispatcher.map(self.address_z_drums, self._on_received_drums)
+        return dispatcher
 
+    def run(self, single_thread=False) -> None:
+        try:
+            self.dispatcher = self._create_dispatcher()
             self.server = BlockingOSCUDPServer(
                 (self.ip, self.port), self.dispatcher)
 
@@ -122,6 +219,58 @@ class OSCServer:
         # time.sleep(20)
         # self.server.shutdown()
 
+    async def run_async(self, extra_ports: Optional[List[int]] = None,
+                        senders: Optional[List["OSCSender"]] = None) -> None:
+        """ serves `port` and every port of `extra_ports` from one event loop
+        until `shutdown` is called.
+
+        handlers only hand z to `data_manager`, whose mailbox workers decode
+        off the loop (a `data_manager` without a mailbox is refused), and
+        `senders` are attached to the loop so replies from those workers go
+        out through it too """
+        if self.data_manager is not None and self.data_manager.mailbox is None:
+            raise ValueError("run_async needs a ReceivedNotesManager with a mailbox "
+                             "(coalesce or per_mode_workers), decodes would block the loop")
+        self.loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(sig, self._stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass  # not supported on this platform / thread
+        if self.sessions is not None:
+            self.sessions.loop = self.loop
+        self.dispatcher = self._create_dispatcher()
+        transports = []
+        port = self.port
+        try:
+            for port in [self.port] + list(extra_ports or []):
+                transport, _ = await AsyncIOOSCUDPServer(
+                    (self.ip, port), self.dispatcher, self.loop).create_serve_endpoint()
+                transports.append(transport)
+                print(f"Serving on {(self.ip, port)}")
+            for sender in senders or []:
+                await sender.attach(self.loop)
+            await self._stop.wait()
+        except OSError:
+            # for nodejs python-shell
+            print(f"address {self.ip} may not be correct")
+            print(f"Port {port} may be used")
+        finally:
+            for transport in transports:
+                transport.close()
+            for sender in senders or []:
+                sender.close()
+            self.loop = None
+
+    def shutdown(self) -> None:
+        """ stops `run` or `run_async`; safe to call from any thread """
+        if self.loop is not None and self._stop is not None:
+            self.loop.call_soon_threadsafe(self._stop.set)
+        elif self.server is not None:
+            self.server.shutdown()
+            self.server = None
+
     def calc_velocity(self, v_x: float, v_y: float, v_z: float) -> int:
         """ v_x, v_y, v_z => velocity (60 - 127) """
         # TODO: ここ確認する
@@ -148,12 +297,57 @@ class OSCServer:
 
 
 class OSCSender:
-    def __init__(self, ip: str, port: int) -> None:
+    def __init__(self, ip: str, port: int, payload_format: str = "string") -> None:
+        assert payload_format in PAYLOAD_FORMATS, \
+            f"payload format must be one of {PAYLOAD_FORMATS}, got {payload_format}"
         self.client = udp_client.SimpleUDPClient(ip, port)
+        self.payload_format = payload_format
+        self.address = (ip, port)
+        # set by `attach`: datagrams are then sent by the event loop
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.transport: Optional[asyncio.DatagramTransport] = None
+
+    async def attach(self, loop: asyncio.AbstractEventLoop) -> None:
+        """ sends through a datagram endpoint of `loop` from now on """
+        self.transport, _ = await loop.create_datagram_endpoint(
+            asyncio.DatagramProtocol, remote_addr=self.address)
+        self.loop = loop
+
+    def close(self) -> None:
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+            self.loop = None
+
+    def _send_dgram(self, dgram: bytes) -> None:
+        if self.transport is not None and self.loop is not None:
+            # workers call this from their own threads
+            self.loop.call_soon_threadsafe(self.transport.sendto, dgram)
+        else:
+            self.client.send(_Datagram(dgram))
 
     def send(self, path: str, msg: str) -> None:
         assert path[0] == "/", "given osc address path is incorrect"
-        self.client.send_message(path, msg)
+        builder = OscMessageBuilder(address=path)
+        builder.add_arg(msg)
+        self._send_dgram(builder.build().dgram)
+
+    def serialize(self, path: str, phrase: Any) -> bytes:
+        """ OSC message of the notes of a `Phrase` in `payload_format`: the token
+        string, or the note array packed straight into typed arguments """
+        assert path[0] == "/", "given osc address path is incorrect"
+        if self.payload_format == "string":
+            builder = OscMessageBuilder(address=path)
+            builder.add_arg(phrase.tokens)
+            return builder.build().dgram
+        return notes_message(path, phrase.notes, self.payload_format)
+
+    def send_payload(self, dgram: bytes) -> None:
+        """ sends a message made by `serialize` """
+        self._send_dgram(dgram)
+
+    def send_notes(self, path: str, phrase: Any) -> None:
+        self.send_payload(self.serialize(path, phrase))
 
     def __del__(self):
         if self.client is not None:
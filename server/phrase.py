@@ -0,0 +1,186 @@
+from typing import Any, Optional
+
+import numpy as np
+import note_seq
+from note_seq.protobuf.music_pb2 import NoteSequence
+
+from metrics import METRICS
+from tokens import note_matrix_to_tokens, note_sequence_to_matrix
+
+# `MelodyOneHotEncoding`: 0 is no event, 1 is note off, the rest are pitches
+NUM_SPECIAL_MELODY_EVENTS = 2
+
+# the magenta converters (and TF with them) are only imported by the functions
+# that read output tensors, a Phrase of a NoteSequence does not need them
+
+
+def _seconds_per_step(converter) -> float:
+    """ step length `from_tensors` uses for the NoteSequence it builds """
+    steps_per_quarter = getattr(converter, "_steps_per_quarter", None)
+    if steps_per_quarter:
+        return 60.0 / (steps_per_quarter * note_seq.DEFAULT_QUARTERS_PER_MINUTE)
+    return 1.0 / converter._steps_per_second
+
+
+def phrase_seconds(converter, num_steps: int,
+                   qpm: float = note_seq.DEFAULT_QUARTERS_PER_MINUTE) -> float:
+    """ how long `num_steps` output steps play at `qpm` """
+    return num_steps * _seconds_per_step(converter) * note_seq.DEFAULT_QUARTERS_PER_MINUTE / qpm
+
+
+def start_notes_at_0(s: NoteSequence) -> NoteSequence:
+    """ If a sequence has notes at time before 0.0, scootch them up to 0 """
+    for n in s.notes:
+        if n.start_time < 0:
+            n.end_time -= n.start_time
+            n.start_time = 0
+    return s
+
+
+def _labels(converter, tensor: np.ndarray) -> np.ndarray:
+    """ argmax of every step, cut at the end token """
+    labels = np.argmax(tensor, axis=-1)
+    if converter.end_token is not None:
+        ends = np.flatnonzero(labels == converter.end_token)
+        if len(ends):
+            labels = labels[:ends[0]]
+    return labels
+
+
+def _steps_to_ms(steps: np.ndarray, seconds_per_step: float) -> np.ndarray:
+    # same float operations as `to_sequence` followed by the `* 1000` of the tokens
+    return steps * seconds_per_step * 1000
+
+
+def melody_notes(converter, tensor: np.ndarray) -> np.ndarray:
+    """ `[n, 4]` pitch, velocity, start_ms, end_ms of a one-hot melody tensor,
+    the same notes `OneHotMelodyConverter.from_tensors` puts in its NoteSequence """
+    from magenta.models.music_vae import data
+
+    labels = _labels(converter, tensor)
+    onsets = np.flatnonzero(labels >= NUM_SPECIAL_MELODY_EVENTS)
+    # a note lasts until the next onset or note off, or the end of the melody
+    events = np.flatnonzero(labels >= NUM_SPECIAL_MELODY_EVENTS - 1)
+    following = np.searchsorted(events, onsets, side="right")
+    ends = np.append(events, len(labels))[following]
+
+    seconds_per_step = _seconds_per_step(converter)
+    notes = np.empty((len(onsets), 4), dtype=np.float64)
+    notes[:, 0] = labels[onsets] - NUM_SPECIAL_MELODY_EVENTS + converter._min_pitch
+    notes[:, 1] = data.OUTPUT_VELOCITY
+    notes[:, 2] = _steps_to_ms(onsets, seconds_per_step)
+    notes[:, 3] = _steps_to_ms(ends, seconds_per_step)
+    return notes
+
+
+def drum_notes(converter, tensor: np.ndarray) -> np.ndarray:
+    """ `[n, 4]` pitch, velocity, start_ms, end_ms of a one-hot drums tensor,
+    the same notes `DrumsConverter.from_tensors` puts in its NoteSequence
+    (within a step, ordered by drum class) """
+    from magenta.models.music_vae import data
+
+    labels = _labels(converter, tensor)
+    num_classes = len(converter._pitch_classes)
+    # every label is a bit mask of the drum classes hit on that step
+    hits = (labels[:, np.newaxis] >> np.arange(num_classes)) & 1
+    steps, classes = np.nonzero(hits)
+    exemplars = np.array([pitches[0] for pitches in converter._pitch_classes])
+
+    seconds_per_step = _seconds_per_step(converter)
+    notes = np.empty((len(steps), 4), dtype=np.float64)
+    notes[:, 0] = exemplars[classes]
+    notes[:, 1] = data.OUTPUT_VELOCITY
+    notes[:, 2] = _steps_to_ms(steps, seconds_per_step)
+    notes[:, 3] = _steps_to_ms(steps + 1, seconds_per_step)
+    return notes
+
+
+def bass_notes(converter, tensor: np.ndarray) -> np.ndarray:
+    """ notes of the bass part of a trio tensor, as `BassConverter.from_tensors` """
+    bounds = np.cumsum(converter._split_output_depths)
+    return melody_notes(converter._melody_converter, tensor[:, bounds[0]:bounds[1]])
+
+
+def tensor_to_notes(converter, tensor: np.ndarray) -> Optional[np.ndarray]:
+    """ `[n, 4]` note array of an output tensor without building a NoteSequence,
+    or None if the converter is not one of the one-hot melody, drums or bass ones """
+    from magenta.models.music_vae import data
+    from midime_data import BassConverter
+
+    if isinstance(converter, BassConverter):
+        return bass_notes(converter, tensor)
+    if isinstance(converter, data.OneHotMelodyConverter):
+        return melody_notes(converter, tensor)
+    if isinstance(converter, data.DrumsConverter) and not converter._roll_output:
+        return drum_notes(converter, tensor)
+    return None
+
+
+class Phrase:
+    """ one decoded output of a model.
+
+    the note array (and the M4L tokens made from it) come straight from the
+    output tensor when the converter allows it; the NoteSequence is only built
+    by `data_converter.from_tensors` when something asks for it, e.g. a MIDI file.
+    """
+
+    def __init__(self, converter: Any, tensor: Optional[np.ndarray] = None,
+                 sequence: Optional[NoteSequence] = None,
+                 mode: Optional[str] = None) -> None:
+        assert tensor is not None or sequence is not None, \
+            "Phrase needs an output tensor or a NoteSequence"
+        self.converter = converter
+        # tag of the latency spans
+        self.mode = mode or "-"
+        self.tensor = tensor
+        self._sequence = sequence
+        self._notes: Optional[np.ndarray] = None
+        self._tokens: Optional[str] = None
+
+    @classmethod
+    def from_sequence(cls, sequence: NoteSequence, converter: Any = None,
+                      mode: Optional[str] = None) -> "Phrase":
+        return cls(converter, sequence=sequence, mode=mode)
+
+    @property
+    def notes(self) -> np.ndarray:
+        """ `[n, 4]` array of pitch, velocity, start_ms and end_ms """
+        if self._notes is None:
+            with METRICS.span("notes", self.mode):
+                if self._sequence is None:
+                    self._notes = tensor_to_notes(self.converter, self.tensor)
+                if self._notes is None:
+                    self._notes = note_sequence_to_matrix(self.sequence)
+        return self._notes
+
+    @property
+    def tokens(self) -> str:
+        """ M4L token string of the notes """
+        if self._tokens is None:
+            notes = self.notes
+            with METRICS.span("tokens", self.mode):
+                self._tokens = note_matrix_to_tokens(notes)
+        return self._tokens
+
+    @property
+    def sequence(self) -> NoteSequence:
+        if self._sequence is None:
+            with METRICS.span("from_tensors", self.mode):
+                sequence = self.converter.from_tensors([self.tensor])[0]
+            self._sequence = start_notes_at_0(sequence)
+        return self._sequence
+
+    @property
+    def has_sequence(self) -> bool:
+        return self._sequence is not None
+
+    def at_tempo(self, qpm: float) -> "Phrase":
+        """ copy whose notes (and tokens) are stretched from the
+        `DEFAULT_QUARTERS_PER_MINUTE` of `from_tensors` to `qpm`; its
+        NoteSequence keeps the default tempo """
+        if qpm == note_seq.DEFAULT_QUARTERS_PER_MINUTE:
+            return self
+        phrase = Phrase(self.converter, self.tensor, self._sequence, self.mode)
+        phrase._notes = self.notes.copy()
+        phrase._notes[:, 2:] *= note_seq.DEFAULT_QUARTERS_PER_MINUTE / qpm
+        return phrase
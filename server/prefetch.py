@@ -0,0 +1,161 @@
+import collections
+import threading
+import time
+from logging import debug, warn
+from typing import Any, Deque, Dict, Hashable, Optional, Tuple
+
+import numpy as np
+
+# how the next z is extrapolated from the recent ones
+PREDICTION_METHODS = ("constant_velocity", "linear")
+
+
+class TrajectoryPrefetcher:
+    """ predicts where the performer's z goes next and decodes it ahead.
+
+    the MR interface moves z smoothly, so the next request of a hand lies
+    close to the line through its last few. `observe` keeps the recent z of
+    every track (session) with their arrival time, and the points expected
+    at the next `num_points` request intervals are decoded into the model's
+    `DecodeCache`: while the model is idle by a worker thread, and as the
+    spare rows of live batches of the `MicroBatchDecoder`. a request that
+    lands on a prefetched cache entry is answered without a `sess.run`.
+
+    `constant_velocity` continues the last step, `linear` a least squares
+    line through the last `history` z, which is steadier on a jittery hand.
+    """
+
+    def __init__(self, vae: Any, method: str = "constant_velocity",
+                 history: int = 4, num_points: int = 2,
+                 idle_sec: float = 0.002, max_tracks: int = 64,
+                 max_prefetched: int = 512) -> None:
+        assert method in PREDICTION_METHODS, \
+            f"prediction method must be one of {PREDICTION_METHODS}, got {method}"
+        self.vae = vae
+        self.method = method
+        self.history = max(history, 2)
+        self.num_points = num_points
+        self.idle_sec = idle_sec
+        self.max_tracks = max_tracks
+        self.max_prefetched = max_prefetched
+
+        self.lookups = 0
+        self.hits = 0
+        self.prefetched = 0
+
+        self._tracks: "collections.OrderedDict[Hashable, Deque[Tuple[float, np.ndarray]]]" = \
+            collections.OrderedDict()
+        # cache keys decoded ahead and not requested yet
+        self._keys: "collections.OrderedDict[Hashable, None]" = collections.OrderedDict()
+        self._pending: Optional[np.ndarray] = None
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="prefetch", daemon=True)
+        self._thread.start()
+
+    def observe(self, z: np.ndarray, track: Hashable = None,
+                t: Optional[float] = None) -> None:
+        """ records a live z of `track` and queues its predicted successors """
+        z = np.asarray(z, dtype=np.float32).reshape(-1)
+        t = time.monotonic() if t is None else t
+        with self._cond:
+            points = self._tracks.pop(track, None)
+            if points is None or (points and points[-1][1].shape != z.shape):
+                points = collections.deque(maxlen=self.history)
+            points.append((t, z))
+            self._tracks[track] = points  # most recent track last
+            while len(self._tracks) > self.max_tracks:
+                self._tracks.popitem(last=False)
+            predicted = self._predict(points, self.num_points)
+            if len(predicted):
+                self._pending = predicted
+                self._cond.notify_all()
+
+    def predict(self, track: Hashable = None, n: Optional[int] = None) -> np.ndarray:
+        """ `[k, dim]` z expected at the next k <= n request intervals of
+        `track`, empty until it has two points """
+        with self._cond:
+            points = self._tracks.get(track)
+            return self._predict(points, n or self.num_points) if points else np.empty((0, 0))
+
+    def spare_rows(self, z: np.ndarray, n: int) -> np.ndarray:
+        """ predictions of the latest track for the spare rows of a batch
+        whose last row is `z` (`MicroBatchDecoder.spare_rows`) """
+        z = np.asarray(z).reshape(-1)
+        with self._cond:
+            if not self._tracks:
+                return np.empty((0, z.shape[0]), np.float32)
+            points = next(reversed(self._tracks.values()))
+            predicted = self._predict(points, n)
+        if len(predicted) == 0 or predicted.shape[1] != z.shape[0]:
+            return np.empty((0, z.shape[0]), np.float32)
+        return predicted
+
+    def _predict(self, points: Deque[Tuple[float, np.ndarray]], n: int) -> np.ndarray:
+        if len(points) < 2 or n <= 0:
+            return np.empty((0, 0), np.float32)
+        times = np.array([t for t, _ in points])
+        zs = np.stack([z for _, z in points])
+        interval = max((times[-1] - times[0]) / (len(times) - 1), 1e-6)
+        ahead = times[-1] + interval * np.arange(1, n + 1)
+        if self.method == "linear" and len(points) > 2:
+            # least squares line per dimension, in one lstsq call
+            design = np.stack([times - times[-1], np.ones_like(times)], axis=1)
+            (slope, intercept), *_ = np.linalg.lstsq(design, zs, rcond=None)
+            predicted = intercept + np.outer(ahead - times[-1], slope)
+        else:
+            velocity = (zs[-1] - zs[-2]) / max(times[-1] - times[-2], 1e-6)
+            predicted = zs[-1] + np.outer(ahead - times[-1], velocity)
+        return predicted.astype(np.float32)
+
+    def mark_prefetched(self, key: Hashable) -> None:
+        """ a decode cache entry was put there ahead of its request """
+        with self._cond:
+            if key not in self._keys:
+                self.prefetched += 1
+            self._keys[key] = None
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.max_prefetched:
+                self._keys.popitem(last=False)
+
+    def record_lookup(self, key: Hashable, hit: bool) -> None:
+        """ counts a live decode cache lookup, a hit on a prefetched entry
+        being a prefetch hit """
+        with self._cond:
+            self.lookups += 1
+            if hit and key in self._keys:
+                del self._keys[key]
+                self.hits += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._cond:
+            return {"lookups": self.lookups,
+                    "prefetched": self.prefetched,
+                    "hits": self.hits,
+                    "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                    "used_rate": self.hits / self.prefetched if self.prefetched else 0.0}
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed or self._pending is not None)
+                if self._closed:
+                    return
+            # only decode once no live request is being decoded
+            while self.vae.in_flight > 0 and not self._closed:
+                time.sleep(self.idle_sec)
+            with self._cond:
+                points, self._pending = self._pending, None
+            if points is None:
+                continue
+            try:
+                n = self.vae.prefetch(points)
+                debug(f"prefetched {n} of {len(points)} predicted z: {self.stats()}")
+            except Exception as e:
+                warn(f"Failed to prefetch: {e}")
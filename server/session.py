@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from osc import OSCSender
+
+DEFAULT_CLIENT_ID = "default"
+
+
+class Session:
+    """ state of one performer (MR headset).
+
+    the models are shared by every session, only what used to be global to
+    the server is kept per client: the latest z of every mode, which
+    `--continuous` streams are generated from, and where the replies go.
+    """
+
+    def __init__(self, client_id: str,
+                 reply_address: Optional[Tuple[str, int]] = None,
+                 sender: Optional[OSCSender] = None) -> None:
+        self.client_id = client_id
+        self.reply_address = reply_address
+        self.sender = sender
+        self.latest_z: Dict[str, np.ndarray] = {}
+        self.last_seen = time.monotonic()
+
+    def __repr__(self) -> str:
+        return f"Session({self.client_id}, reply_address={self.reply_address})"
+
+
+class SessionRegistry:
+    """ sessions keyed by the client id sent with z, or by the sender's
+    address when there is none. replies of a session go to the sender's ip
+    at `send_port` unless the client registered another port. """
+
+    def __init__(self, send_port: Optional[int] = None,
+                 payload_format: str = "string") -> None:
+        self.send_port = send_port
+        self.payload_format = payload_format
+        # set in asyncio mode, new senders are then attached to it
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._sessions: Dict[str, Session] = {}
+        self._lock = threading.Lock()
+
+    def get(self, client_id: Optional[str],
+            client_address: Optional[Tuple[str, int]] = None) -> Session:
+        if client_id is None:
+            client_id = f"{client_address[0]}:{client_address[1]}" \
+                if client_address else DEFAULT_CLIENT_ID
+        with self._lock:
+            session = self._sessions.get(client_id)
+            if session is None:
+                session = Session(client_id)
+                self._sessions[client_id] = session
+                if client_address and self.send_port is not None:
+                    self._set_reply_address(session, (client_address[0], self.send_port))
+                print(f"new session: {session}")
+            session.last_seen = time.monotonic()
+            return session
+
+    def set_reply_port(self, client_id: str, client_address: Tuple[str, int],
+                       port: int) -> Session:
+        session = self.get(client_id, client_address)
+        with self._lock:
+            self._set_reply_address(session, (client_address[0], port))
+        return session
+
+    def _set_reply_address(self, session: Session, address: Tuple[str, int]) -> None:
+        if session.reply_address == address:
+            return
+        if session.sender is not None:
+            session.sender.close()
+        session.reply_address = address
+        session.sender = OSCSender(address[0], address[1], payload_format=self.payload_format)
+        if self.loop is not None:
+            # called from a handler running on the loop
+            self.loop.create_task(session.sender.attach(self.loop))
+
+    def sessions(self) -> List[Session]:
+        with self._lock:
+            return list(self._sessions.values())
+
+    def close(self) -> None:
+        for session in self.sessions():
+            if session.sender is not None:
+                session.sender.close()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
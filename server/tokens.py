@@ -0,0 +1,24 @@
+from typing import Optional
+
+import numpy as np
+
+# one note of the M4L token string: `pitch velocity start_ms end_ms`
+NOTE_FORMAT = "%d %d %.2f %.2f"
+
+
+def note_matrix_to_tokens(notes: Optional[np.ndarray]) -> str:
+    """ formats a `[n, 4]` array of pitch, velocity, start_ms and end_ms
+    into the M4L token string with a single `%` call """
+    if notes is None or len(notes) == 0:
+        return ""
+    notes = np.asarray(notes, dtype=np.float64)
+    return " ".join([NOTE_FORMAT] * len(notes)) % tuple(notes.ravel().tolist())
+
+
+def note_sequence_to_matrix(seq) -> np.ndarray:
+    """ pitch, velocity, start_ms and end_ms of every note of a NoteSequence
+    as a `[n, 4]` float64 array, read in a single pass """
+    notes = np.array([(n.pitch, n.velocity, n.start_time, n.end_time)
+                      for n in seq.notes], dtype=np.float64).reshape(-1, 4)
+    notes[:, 2:] *= 1000
+    return notes